@@ -1,14 +1,163 @@
 import pandas as pd
 import argparse
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
 import requests
-import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
-#requests_cache.install_cache('demo_cache')
 
-def query_usi(usi, database, analog=False, precursor_mz_tol=0.02, fragment_mz_tol=0.02, min_cos=0.7):
-    URL = "https://fasst.gnps2.org/search"
+# Keep-alive connections to fasst.gnps2.org for all queries, 5xx and timeouts are retried with jittered backoff
+session = requests.Session()
+
+def _retry():
+    retry_arguments = {"total": 3, "backoff_factor": 0.5, "status_forcelist": [429, 500, 502, 503, 504]}
+
+    try:
+        # urllib3 2, so the clients do not retry in lockstep
+        return Retry(backoff_jitter=0.5, **retry_arguments)
+    except TypeError:
+        return Retry(**retry_arguments)
+
+def configure_session(pool_maxsize=10):
+    session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=_retry()))
+
+configure_session()
+
+class RateLimiter:
+    """
+    Token bucket, at most rate requests per second with bursts of up to one second worth of requests.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+class ConcurrencyController:
+    """
+    Limit of the queries in flight, with AIMD when adaptive: after every window of queries the limit goes up by
+    one, or is halved when the window's p90 latency is above the target or too many queries failed or were
+    throttled (429). Without a target latency the window's p90 is compared with the best window p90 seen,
+    usually from the first windows at a low limit, and the limit is halved once it has grown latency_inflation
+    times that.
+
+    Also keeps the statistics for the progress bar and the summary.
+    """
+    WINDOW = 20
+
+    def __init__(self, max_limit, adaptive=False, initial_limit=2, target_latency=None, max_error_rate=0.05,
+                 latency_inflation=2.0):
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.limit = min(max_limit, initial_limit) if adaptive else max_limit
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.latency_inflation = latency_inflation
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.window = []
+        self.latencies = []
+        self.best_p90 = None
+        self.start_time = time.time()
+        self.stats = {"queries": 0, "errors": 0, "throttled": 0, "retries": 0, "increases": 0, "decreases": 0,
+                      "min_limit": self.limit, "max_limit": self.limit}
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, failed=False, throttled=0, retries=0):
+        with self.condition:
+            self.in_flight -= 1
+
+            self.latencies.append(latency)
+            self.stats["queries"] += 1
+            self.stats["errors"] += 1 if failed else 0
+            self.stats["throttled"] += throttled
+            self.stats["retries"] += retries
+
+            self.window.append((latency, failed or throttled > 0))
+            if self.adaptive and len(self.window) >= max(self.WINDOW, self.limit):
+                self._adjust()
+
+            self.condition.notify_all()
+
+    def _adjust(self):
+        latencies = [latency for latency, bad in self.window]
+        bad_rate = sum(1 for latency, bad in self.window if bad) / len(self.window)
+        self.window = []
+
+        # Same statistic on both sides, the baseline is the least loaded window
+        p90 = _percentile(latencies, 90)
+        if self.best_p90 is None or p90 < self.best_p90:
+            self.best_p90 = p90
+        target_latency = self.target_latency or self.latency_inflation * self.best_p90
+
+        if bad_rate > self.max_error_rate or p90 > target_latency:
+            self.limit = max(1, self.limit // 2)
+            self.stats["decreases"] += 1
+        elif self.limit < self.max_limit:
+            self.limit += 1
+            self.stats["increases"] += 1
+
+        self.stats["min_limit"] = min(self.stats["min_limit"], self.limit)
+        self.stats["max_limit"] = max(self.stats["max_limit"], self.limit)
+
+    def postfix(self):
+        return {
+            "limit": self.limit,
+            "qps": "{:.1f}".format(self.stats["queries"] / max(time.time() - self.start_time, 1e-9)),
+            "p90": "{:.1f}s".format(_percentile(self.latencies[-100:], 90)),
+            "errors": self.stats["errors"],
+        }
 
-    params = {
+    def summary(self):
+        elapsed = time.time() - self.start_time
+
+        return dict(self.stats,
+                    final_limit=self.limit,
+                    seconds=round(elapsed, 1),
+                    queries_per_second=round(self.stats["queries"] / max(elapsed, 1e-9), 2),
+                    p50_seconds=round(_percentile(self.latencies, 50), 2),
+                    p90_seconds=round(_percentile(self.latencies, 90), 2),
+                    p99_seconds=round(_percentile(self.latencies, 99), 2))
+
+def query_params(usi, database, analog=False, precursor_mz_tol=0.02, fragment_mz_tol=0.02, min_cos=0.7):
+    return {
         "usi": usi,
         "library": database,
         "analog": "Yes" if analog else "No",
@@ -17,31 +166,429 @@ def query_usi(usi, database, analog=False, precursor_mz_tol=0.02, fragment_mz_to
         "cosine_threshold": min_cos,
     }
 
-    r = requests.get(URL, params=params, timeout=50)
+def query_usi_response(usi, database, analog=False, precursor_mz_tol=0.02, fragment_mz_tol=0.02, min_cos=0.7):
+    URL = "https://fasst.gnps2.org/search"
+
+    params = query_params(usi, database, analog=analog, precursor_mz_tol=precursor_mz_tol,
+                          fragment_mz_tol=fragment_mz_tol, min_cos=min_cos)
+
+    return session.get(URL, params=params, timeout=50)
+
+def query_usi(usi, database, analog=False, precursor_mz_tol=0.02, fragment_mz_tol=0.02, min_cos=0.7):
+    r = query_usi_response(usi, database, analog=analog, precursor_mz_tol=precursor_mz_tol,
+                           fragment_mz_tol=fragment_mz_tol, min_cos=min_cos)
     r.raise_for_status()
 
     return r.json()
 
-def masst_query_all(usi_list, masst_type, analog=False, precursor_mz_tol=0.02, fragment_mz_tol=0.02, min_cos=0.7):
+# fastMASST rebuilds its index once a day
+INDEX_REFRESH_HOUR_UTC = 0
+
+def current_index_version(now=None):
+    """
+    Identifies the nightly index build that a query right now runs against, e.g. 2024061500
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    last_refresh = now.replace(hour=INDEX_REFRESH_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if last_refresh > now:
+        last_refresh -= datetime.timedelta(days=1)
+
+    return last_refresh.strftime("%Y%m%d%H")
+
+class ResponseCache:
+    """
+    On-disk cache of the fasst results, one JSON file per query under cache_dir/<index version>/, keyed on the
+    query parameters (USI, library, analog, tolerances, cosine). A new index version starts an empty folder,
+    so cached results live as long as the index they came from. Pass index_version to keep using one version.
+
+    Files are written to a temporary file and renamed, so any number of threads and processes can read and
+    write the same cache.
+    """
+    def __init__(self, cache_dir, index_version=None, refresh=False):
+        if index_version is None:
+            index_version = current_index_version()
+
+        self.index_version = index_version
+        self.folder = os.path.join(cache_dir, index_version)
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0}
+
+    def _path(self, params):
+        key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.folder, key[:2], key + ".json")
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, params):
+        """
+        :return: cached results dict, None when not cached or refreshing
+        """
+        if not self.refresh:
+            try:
+                with open(self._path(params)) as f:
+                    results_dict = json.load(f)
+                self._count("hits")
+                return results_dict
+            except (OSError, ValueError):
+                pass
+
+        self._count("misses")
+        return None
+
+    def set(self, params, results_dict):
+        path = self._path(params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, "w") as f:
+            json.dump(results_dict, f)
+        os.replace(temp_path, path)
+
+        self._count("writes")
+
+def load_checkpoint(checkpoint_file, parameters):
+    """
+    Checkpoint of a batch: a line with the query parameters, then one JSON line per finished USI with its results.
+    Only appended to, a line cut off by a crash is ignored. The parameters hold the index version, so results
+    from an older fasst index are not mixed with new ones.
+
+    :return: dict of USI -> offset of its line for the finished USIs, empty when there is no checkpoint for these parameters
+    """
+    finished = {}
+    try:
+        f = open(checkpoint_file, "rb")
+    except FileNotFoundError:
+        return finished
+
+    with f:
+        try:
+            checkpoint_parameters = json.loads(f.readline())["parameters"]
+        except (KeyError, ValueError):
+            checkpoint_parameters = None
+
+        if checkpoint_parameters != parameters:
+            if isinstance(checkpoint_parameters, dict) and checkpoint_parameters.get("index_version") != parameters.get("index_version"):
+                print("Checkpoint", checkpoint_file, "is from index version", checkpoint_parameters.get("index_version"),
+                      "instead of", parameters.get("index_version"), "starting over", file=sys.stderr, flush=True)
+            else:
+                print("Checkpoint", checkpoint_file, "is for other parameters, starting over", file=sys.stderr, flush=True)
+            return finished
+
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if len(line) == 0:
+                break
+
+            try:
+                finished[json.loads(line)["usi"]] = offset
+            except (KeyError, ValueError):
+                continue
+
+    return finished
+
+def read_checkpoint_results(f, offset):
+    f.seek(offset)
+    return json.loads(f.readline())["results"]
+
+class ResultsWriter:
+    """
+    Writes the results as the queries finish, in chunks of flush_rows, so memory does not grow with the run.
+
+    The columns and their types are fixed by the first results, later results are cast to them (values that do
+    not fit become empty). query_usi and the dataset columns are dictionary encoded. The format comes from the
+    file extension: .parquet, .arrow (Arrow IPC stream, pyarrow is only needed for these two) or else TSV.
+    Without any results the file is still written, empty.
+    """
+    DICTIONARY_COLUMNS = ["query_usi", "Dataset", "dataset"]
+
+    def __init__(self, filename, flush_rows=10000):
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.format = os.path.splitext(filename)[1].lower()
+        self.columns = None
+        self.schema = None
+        self.buffer = []
+        self.buffered_rows = 0
+        self.rows = 0
+        self.file = None
+        self.writer = None
+
+    def write(self, results_df):
+        if len(results_df) == 0:
+            return
+
+        if self.columns is None:
+            self.columns = list(results_df.columns)
+        elif list(results_df.columns) != self.columns:
+            results_df = results_df.reindex(columns=self.columns)
+
+        self.buffer.append(results_df)
+        self.buffered_rows += len(results_df)
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def _arrow_schema(self, results_df):
+        import pyarrow as pa
+
+        fields = []
+        for column in self.columns:
+            if column in self.DICTIONARY_COLUMNS:
+                fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+            elif pd.api.types.is_bool_dtype(results_df[column]):
+                fields.append(pa.field(column, pa.bool_()))
+            elif pd.api.types.is_numeric_dtype(results_df[column]):
+                fields.append(pa.field(column, pa.float64()))
+            else:
+                fields.append(pa.field(column, pa.string()))
+
+        return pa.schema(fields)
+
+    def _arrow_table(self, results_df):
+        import pyarrow as pa
+
+        for field in self.schema:
+            column = results_df[field.name]
+            if pa.types.is_string(field.type) or pa.types.is_dictionary(field.type):
+                results_df[field.name] = column.where(column.isna(), column.astype(str))
+            elif pa.types.is_boolean(field.type) and not pd.api.types.is_bool_dtype(column):
+                results_df[field.name] = column.map(
+                    lambda value: value if isinstance(value, bool) else
+                    {"true": True, "false": False}.get(str(value).lower()) if isinstance(value, str) else
+                    None if pd.isna(value) else bool(value)).astype(object)
+            elif pa.types.is_floating(field.type) and not pd.api.types.is_float_dtype(column):
+                results_df[field.name] = pd.to_numeric(column, errors="coerce").astype("float64")
+
+        return pa.Table.from_pandas(results_df, schema=self.schema, preserve_index=False)
+
+    def _open_arrow(self, results_df):
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        self.schema = self._arrow_schema(results_df)
+        if self.format == ".parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        else:
+            # The stream format, the file format can not change the dictionaries between chunks
+            self.writer = pyarrow.ipc.new_stream(self.filename, self.schema)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        results_df = pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+        self.buffered_rows = 0
+
+        if self.format in [".parquet", ".arrow"]:
+            if self.writer is None:
+                self._open_arrow(results_df)
+
+            self.writer.write_table(self._arrow_table(results_df))
+        else:
+            if self.file is None:
+                self.file = open(self.filename, "w")
+                self.file.write("\t".join(self.columns) + "\n")
+
+            results_df.to_csv(self.file, sep="\t", index=False, header=False)
+            self.file.flush()
+
+        self.rows += len(results_df)
+
+    def close(self):
+        self.flush()
+
+        # No results at all, still an empty file with the columns known so far
+        if self.columns is None:
+            self.columns = ["query_usi"]
+        if self.format in [".parquet", ".arrow"] and self.writer is None:
+            self._open_arrow(pd.DataFrame(columns=self.columns, dtype=object))
+        elif self.format not in [".parquet", ".arrow"] and self.file is None:
+            self.file = open(self.filename, "w")
+            self.file.write("\t".join(self.columns) + "\n")
+
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.file.close()
+
+# Queries submitted ahead of the output per worker, see masst_query_all
+IN_FLIGHT_PER_WORKER = 4
+
+def masst_query_all(usi_list, masst_type, analog=False, precursor_mz_tol=0.02, fragment_mz_tol=0.02, min_cos=0.7,
+                    workers=1, rate=None, adaptive=False, target_latency=None, checkpoint_file=None, output_file=None,
+                    cache=None):
+    """
+    :param workers: queries in flight at the same time, the maximum when adaptive
+    :param rate: optional limit of queries per second
+    :param adaptive: adjusts the queries in flight to the latency and errors of fasst, see ConcurrencyController
+    :param target_latency: optional p90 latency in seconds for adaptive
+    :param checkpoint_file: optional file the results are appended to as the queries finish, the USIs already in it
+                            are not queried again, see load_checkpoint
+    :param output_file: optional file the results are streamed to with ResultsWriter, instead of being returned
+    :param cache: optional ResponseCache, cached queries do not go to fasst
+    :return: results of all USIs in the input order, USIs that still fail after the retries are left out,
+             the number of rows written with output_file
+    """
     database_name = "gnpsdata_index"
 
+    finished = {}
+    checkpoint = None
+    checkpoint_lock = threading.Lock()
+    if checkpoint_file is not None:
+        # A pinned cache keeps its version, otherwise the results come from the nightly index
+        index_version = cache.index_version if cache is not None else current_index_version()
+        parameters = {"database": database_name, "analog": analog, "precursor_mz_tol": precursor_mz_tol,
+                      "fragment_mz_tol": fragment_mz_tol, "min_cos": min_cos, "index_version": index_version}
+        finished = load_checkpoint(checkpoint_file, parameters)
+
+        if len(finished) == 0:
+            checkpoint = open(checkpoint_file, "wb")
+            checkpoint.write(json.dumps({"parameters": parameters}).encode() + b"\n")
+        else:
+            print("Resuming,", len(finished), "USIs already done", file=sys.stderr, flush=True)
+            with open(checkpoint_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                cut_off = f.read(1) != b"\n"
+            checkpoint = open(checkpoint_file, "ab")
+            # After a line cut off by a crash
+            if cut_off:
+                checkpoint.write(b"\n")
+        checkpoint.flush()
+
+        checkpoint_reader = open(checkpoint_file, "rb")
+
+    configure_session(pool_maxsize=max(10, workers))
+    rate_limiter = RateLimiter(rate) if rate else None
+    controller = ConcurrencyController(workers, adaptive=adaptive, target_latency=target_latency)
+
+    def fetch(usi):
+        controller.acquire()
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        start_time = time.time()
+        r = None
+        results_dict = None
+        throttled = 0
+        try:
+            r = query_usi_response(usi, database_name,
+                analog=analog, precursor_mz_tol=precursor_mz_tol,
+                fragment_mz_tol=fragment_mz_tol, min_cos=min_cos)
+            r.raise_for_status()
+            results_dict = r.json()
+        except (requests.RequestException, ValueError) as e:
+            print("Query failed", usi, repr(e), file=sys.stderr, flush=True)
+            # Retries used up on 429 responses
+            if isinstance(e, requests.exceptions.RetryError) and "429" in str(e):
+                throttled += 1
+        finally:
+            # The retries inside the session are counted too, a 429 that was retried is still throttling
+            retries = []
+            try:
+                retries = r.raw.retries.history
+            except AttributeError:
+                pass
+            throttled += sum(1 for retry in retries if retry.status == 429)
+            if r is not None and r.status_code == 429:
+                throttled += 1
+
+            controller.release(time.time() - start_time, failed=results_dict is None, throttled=throttled, retries=len(retries))
+
+        return results_dict
+
+    def query(usi):
+        params = query_params(usi, database_name, analog=analog, precursor_mz_tol=precursor_mz_tol,
+                              fragment_mz_tol=fragment_mz_tol, min_cos=min_cos)
+
+        results_dict = cache.get(params) if cache is not None else None
+        if results_dict is None:
+            results_dict = fetch(usi)
+            if cache is not None and results_dict is not None:
+                try:
+                    cache.set(params, results_dict)
+                except OSError as e:
+                    print("Could not cache", usi, repr(e), file=sys.stderr, flush=True)
+
+        # Written as soon as it is done, not in input order, so a crash only loses the queries in flight.
+        # Only the offset is kept, the results are read back when it is their turn in the output.
+        if checkpoint is not None and results_dict is not None:
+            with checkpoint_lock:
+                offset = checkpoint.tell()
+                checkpoint.write(json.dumps({"usi": usi, "results": results_dict["results"]}).encode() + b"\n")
+                checkpoint.flush()
+            return offset
+
+        return results_dict
+
     output_results_list = []
+    writer = ResultsWriter(output_file) if output_file is not None else None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        progress = tqdm(total=len(usi_list), initial=sum(1 for usi in usi_list if usi in finished))
+
+        # Only a window of queries is submitted ahead of the output, in input order, so the results waiting for
+        # a slow query before them stay bounded, with or without a checkpoint
+        pending_usis = iter([usi for usi in usi_list if usi not in finished])
+        pending_results = collections.deque()
+
+        def submit_next():
+            usi = next(pending_usis, None)
+            if usi is not None:
+                pending_results.append(executor.submit(query, usi))
+
+        for i in range(workers * IN_FLIGHT_PER_WORKER):
+            submit_next()
+
+        for usi in usi_list:
+            if usi in finished:
+                results = read_checkpoint_results(checkpoint_reader, finished[usi])
+            else:
+                outcome = pending_results.popleft().result()
+                submit_next()
+                progress.update(1)
+                progress.set_postfix(controller.postfix(), refresh=False)
+
+                if outcome is None:
+                    continue
+                results = read_checkpoint_results(checkpoint_reader, outcome) if checkpoint is not None else outcome["results"]
+
+            results_df = pd.DataFrame(results)
+
+            # TODO: Support munging of microbemasst results
+            #if masst_type == "microbemasst":
+                # Lets do additionally processing
+            #    print("MICROBEMASST")
+            # TODO: Merge with metadata automatically
+
+            results_df["query_usi"] = usi
+            if writer is not None:
+                writer.write(results_df)
+            else:
+                output_results_list.append(results_df)
+
+        progress.close()
+
+    if checkpoint is not None:
+        checkpoint.close()
+        checkpoint_reader.close()
+
+    print("Summary", controller.summary(), file=sys.stderr, flush=True)
+    if cache is not None:
+        print("Cache", cache.folder, cache.stats, file=sys.stderr, flush=True)
+
+    if writer is not None:
+        writer.close()
+        return writer.rows
+
+    if len(output_results_list) == 0:
+        return pd.DataFrame()
 
-    for usi in tqdm(usi_list):
-        results_dict = query_usi(usi, database_name,
-            analog=analog, precursor_mz_tol=precursor_mz_tol, 
-            fragment_mz_tol=fragment_mz_tol, min_cos=min_cos)
-        results_df = pd.DataFrame(results_dict["results"])
-
-        # TODO: Support munging of microbemasst results
-        #if masst_type == "microbemasst":
-            # Lets do additionally processing
-        #    print("MICROBEMASST")
-        # TODO: Merge with metadata automatically
-
-        results_df["query_usi"] = usi
-        output_results_list.append(results_df)
-    
     output_results_df = pd.concat(output_results_list)
 
     return output_results_df
@@ -49,9 +596,28 @@ def masst_query_all(usi_list, masst_type, analog=False, precursor_mz_tol=0.02, f
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Fast MASST Client')
     parser.add_argument('input_file', help='file to query with USIs')
-    parser.add_argument('output_file', help='output_file')
+    parser.add_argument('output_file', help='output_file, TSV or by extension .parquet or .arrow')
     parser.add_argument('--masst_type', help='Type of MASST to give youresults: gnpsdata, microbemasst', default="masst")
+    parser.add_argument('--workers', help='queries in flight at the same time, the maximum with --adaptive', type=int, default=4)
+    parser.add_argument('--rate', help='maximum queries per second, no limit by default', type=float, default=None)
+    parser.add_argument('--adaptive', help='adjust the queries in flight to the latency and errors of fasst', action='store_true')
+    parser.add_argument('--target_latency', help='p90 latency in seconds for --adaptive, default 2x the best window p90', type=float, default=None)
+    parser.add_argument('--no_resume', help='query every USI again instead of resuming from the checkpoint', action='store_true')
+    parser.add_argument('--cache_dir', '--cache-dir', help='folder to cache the fasst results in, off by default', default=None)
+    parser.add_argument('--refresh', help='query fasst again for every USI, updates the cache and starts a new checkpoint', action='store_true')
+    parser.add_argument('--index_version', help='cache entries of this index version instead of the nightly one', default=None)
     args = parser.parse_args()
 
-    output_results_df = masst_query_all(pd.read_csv(args.input_file)["usi"], args.masst_type)
-    output_results_df.to_csv(args.output_file, index=False, sep="\t")
\ No newline at end of file
+    cache = ResponseCache(args.cache_dir, index_version=args.index_version, refresh=args.refresh) if args.cache_dir else None
+
+    # Next to the output, a rerun with the same output skips the USIs that are done.
+    # --refresh queries fasst again, so it starts over like --no_resume
+    checkpoint_file = args.output_file + ".checkpoint.jsonl"
+    if (args.no_resume or args.refresh) and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    # Streamed to the output as the queries finish, memory stays flat for large batches
+    masst_query_all(pd.read_csv(args.input_file)["usi"], args.masst_type,
+                    workers=args.workers, rate=args.rate,
+                    adaptive=args.adaptive, target_latency=args.target_latency,
+                    checkpoint_file=checkpoint_file, output_file=args.output_file, cache=cache)
\ No newline at end of file
@@ -27,6 +27,7 @@ import uuid
 
 from flask_caching import Cache
 #import tasks
+import masst_results
 
 from app import app
 
@@ -284,7 +285,7 @@ def determine_task(search):
             ])
 def draw_output(usi1, analog_search):
     #result = tasks.task_searchmasst.delay(usi1, analog_search)
-    result_list = result.get()
+    result_list = masst_results.to_records(result.get())
 
     if len(result_list) == 0:
         return ["No Matches"]
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import dash
 import werkzeug.utils
-from dash import dcc, html, ctx
+from dash import dcc, html, ctx, dash_table
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 import os
@@ -12,6 +12,7 @@ from flask import Flask, send_file, request
 
 from flask_caching import Cache
 from app import app
+import masst_search
 
 dash_app = dash.Dash(
     name="dashinterface",
@@ -90,6 +91,13 @@ DATASELECTION_CARD = [
                 ],
                 className="mb-3"
             ),
+            dcc.Upload(
+                id='mgf_upload',
+                children=html.Div("Drag and drop or click to select an MGF, mzML or mzXML file, all of its MS2 spectra are searched as one batch. Pasting an MGF into the peaks box works too."),
+                style={"borderWidth": "1px", "borderStyle": "dashed", "borderRadius": "5px", "textAlign": "center", "padding": "10px"},
+                max_size=100 * 1024 * 1024,
+                className="mb-3",
+            ),
             dbc.InputGroup(
                 [
                     dbc.InputGroupText("Precursor m/z"),
@@ -144,6 +152,12 @@ DATASELECTION_CARD = [
                         className="d-grid gap-2",
                     )
                 ]),
+                dbc.Col([
+                    html.Div(
+                        dbc.Button("Search microbeMASST by MGF File", color="warning", id="search_button_file", n_clicks=0),
+                        className="d-grid gap-2",
+                    )
+                ]),
                 dbc.Col([
                     html.Div(
                         dbc.Button("Copy Link", color="warning", id="copy_link_button", n_clicks=0),
@@ -180,11 +194,16 @@ MIDDLE_DASHBOARD = [
     dbc.CardHeader(html.H5("Data Exploration")),
     dbc.CardBody(
         [
+            dcc.Store(id="search_task"),
+            dcc.Store(id="mgf_upload_data"),
+            dcc.Store(id="partial_matches_shown", data=False),
+            dcc.Interval(id="search_poll", interval=2000, disabled=True),
             dcc.Loading(
                 id="output",
                 children=[html.Div([html.Div(id="loading-output-23")])],
                 type="default",
             ),
+            html.Div(id="partial_matches"),
             html.Br(),
             html.Hr(),
             html.Br(),
@@ -312,11 +331,12 @@ def determine_task(search):
 
 
 @dash_app.callback([
-                Output('output', 'children')
+                Output('search_task', 'data')
               ],
               [
                 Input('search_button_usi', 'n_clicks'),
                 Input('search_button_peaks', 'n_clicks'),
+                Input('search_button_file', 'n_clicks'),
               ],
               [
                 State('usi1', 'value'),
@@ -328,11 +348,14 @@ def determine_task(search):
                 State('min_matched_peaks', 'value'),
                 State('analog_select', 'value'),
                 State('delta_mass_below', 'value'),
-                State('delta_mass_above', 'value')
+                State('delta_mass_above', 'value'),
+                State('mgf_upload_data', 'data'),
+                State('search_task', 'data'),
               ])
 def draw_output(
                 search_button_usi,
                 search_button_peaks,
+                search_button_file,
                 usi1,
                 peaks,
                 precursor_mz,
@@ -342,7 +365,9 @@ def draw_output(
                 min_matched_peaks,
                 use_analog,
                 analog_mass_below,
-                analog_mass_above):
+                analog_mass_above,
+                mgf_upload,
+                previous_search_task):
 
     button_id = ctx.triggered_id if not None else 'No clicks yet'
 
@@ -350,7 +375,7 @@ def draw_output(
     print("HERE", search_button_usi, button_id, file=sys.stderr)
 
     # This is on load
-    if search_button_usi == 0 and search_button_peaks == 0:
+    if search_button_usi == 0 and search_button_peaks == 0 and search_button_file == 0:
         return [dash.no_update]
 
     # For MicrobeMASST code from robin
@@ -358,93 +383,54 @@ def draw_output(
     # sys.path.insert(0, "microbe_masst/code/")
     # import microbe_masst
 
-    import uuid
-    mangling = str(uuid.uuid4())
-    output_temp = os.path.join("temp", "microbemasst", mangling)
-    os.makedirs(output_temp, exist_ok=True)
-
-    out_file = "../../{}/fastMASST".format(output_temp)
-
-    # TODO seems to always run analog
-    use_analog = use_analog == "Yes"
-
-    # If USI is a list
-    if len(usi1) == 1:
-        usi1 = usi1[0]
-
-    if button_id == "search_button_usi":
-        cmd = 'cd microbe_masst/code/ && python masst_client.py \
-        --usi_or_lib_id "{}" \
-        --out_file "{}" \
-        --precursor_mz_tol {} \
-        --mz_tol {} \
-        --min_cos {} \
-        --min_matched_signals {} \
-        --analog_mass_below {} \
-        --analog_mass_above {} \
-        --database metabolomicspanrepo_index_nightly \
-        '.format(usi1,
-                out_file,
-                prec_mz_tol,
-                ms2_mz_tol,
-                min_cos,
-                min_matched_peaks,
-                analog_mass_below,
-                analog_mass_above
-                )
-
-        # Tacking on the analog flag
-        if use_analog:
-            cmd += " --analog true"
-
-
-    elif button_id == "search_button_peaks":
-        # Writing out the MGF file if we are using peaks
-        print("USING PEAKS")
-        mgf_string = """BEGIN IONS
-PEPMASS={}
-MSLEVEL=2
-CHARGE=1
-{}
-END IONS\n""".format(precursor_mz, peaks.replace(",", " ").replace("\t", " "))
-
-        mgf_filename = os.path.join(output_temp, "input_spectra.mgf")
-        with open(mgf_filename, "w") as o:
-            o.write(mgf_string)
-
-        cmd = 'cd microbe_masst/code/ && python masst_batch_client.py \
-        --in_file "{}" \
-        --out_file "{}" \
-        --parallel_queries 1 \
-        --precursor_mz_tol {} \
-        --mz_tol {} \
-        --min_cos {} \
-        --min_matched_signals {} \
-        --analog {} \
-        --analog_mass_below {} \
-        --analog_mass_above {} \
-        --database metabolomicspanrepo_index_nightly \
-        '.format(os.path.join("../..", mgf_filename),
-                out_file,
-                prec_mz_tol,
-                ms2_mz_tol,
-                min_cos,
-                min_matched_peaks,
-                use_analog,
-                analog_mass_below,
-                analog_mass_above
-                )
+    form = {
+        "usi": usi1,
+        "peaks": peaks,
+        "precursor_mz": precursor_mz,
+        "pm_tolerance": prec_mz_tol,
+        "fragment_tolerance": ms2_mz_tol,
+        "cosine_threshold": min_cos,
+        "min_matched_peaks": min_matched_peaks,
+        "analog": use_analog,
+        "delta_mass_below": analog_mass_below,
+        "delta_mass_above": analog_mass_above,
+    }
 
-    import sys
-    print(cmd, file=sys.stderr, flush=True)
-    os.system(cmd)
+    # The search runs on the worker, draw_search_status polls for it
+    return [masst_search.search_task_from_form(button_id, form, mgf_upload, previous_search_task,
+                                               database="metabolomicspanrepo_index_nightly")]
 
-    response_list = [html.Iframe(src="/microbemasst/results?task={}&analog={}".format(mangling, use_analog), width="100%", height="900px")]
+@dash_app.callback([
+                Output('mgf_upload', 'children'),
+                Output('mgf_upload_data', 'data'),
+              ],
+              [
+                Input('mgf_upload', 'contents'),
+              ],
+              [
+                State('mgf_upload', 'filename'),
+              ])
+def read_upload(contents, filename):
+    # Parsed once here and kept on the server, a search only sends the upload id
+    return masst_search.upload_view(contents, filename, "Search microbeMASST by MGF File")
 
-    # Creating download link for the results
-    response_list.append(html.Br())
-    response_list.append(html.A("Download Results", href="/microbemasst/results?task={}&analog={}".format(mangling, use_analog), download="mangling.html", target="_blank"))
-    return [response_list]
+@dash_app.callback([
+                Output('output', 'children'),
+                Output('search_poll', 'disabled'),
+                Output('partial_matches', 'children'),
+                Output('partial_matches_shown', 'data'),
+              ],
+              [
+                Input('search_task', 'data'),
+                Input('search_poll', 'n_intervals'),
+              ],
+              [
+                State('partial_matches_shown', 'data'),
+              ])
+def draw_search_status(search_task, n_intervals, partial_matches_shown):
+    # A new search, the matches of the previous one go
+    return masst_search.status_view(search_task, partial_matches_shown, ctx.triggered_id == "search_task",
+                                    "/microbemasst/results?task={task}&analog={analog}")
 
 @dash_app.callback([
                 Output('spectrummirror', 'children')
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Sorted precursor m/z catalog of the library spectra, to find the candidates of a search window.
+
+The catalog is built from the library MGF files that ./bin/library was indexed from (./bin/search keeps no
+readable list of its spectra) and stored as .npy arrays sorted by precursor m/z, which are memory mapped:
+
+    bin/catalog/precursor_mz.npy  precursor m/z
+    bin/catalog/file_index.npy    library file of the spectrum, see files.json
+    bin/catalog/scan.npy          scan, SCANS or else the position in the file
+    bin/catalog/offset.npy        byte offset of the spectrum in its file, for read_spectrum
+    bin/catalog/files.json        library files and their datasets
+
+The row in the catalog is the spectrum id. Any window, exact or analog, is two binary searches:
+
+    python masst_catalog.py build library_list.txt -r
+    python masst_catalog.py count query.mgf --below 130 --above 200
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+CATALOG_FOLDER = os.path.join("bin", "catalog")
+FILES_FILENAME = "files.json"
+
+ARRAYS = ["precursor_mz", "file_index", "scan", "offset"]
+
+# Window of an exact search, the analog window comes from delta_mass_below/above of the dashboards
+PM_TOLERANCE = float(os.environ.get("MASST_CATALOG_PM_TOLERANCE", 0.05))
+
+
+def _read_mgf_index(filename):
+    """
+    :return: generator of (precursor m/z, scan, byte offset) of the spectra of an MGF file
+    """
+    offset = 0
+    spectrum_offset = None
+    precursor_mz = None
+    scan = None
+    position = 0
+
+    with open(filename, "rb") as f:
+        for line in f:
+            upper = line.strip().upper()
+
+            if upper == b"BEGIN IONS":
+                spectrum_offset = offset
+                precursor_mz = None
+                scan = None
+                position += 1
+            elif spectrum_offset is None:
+                pass
+            elif upper == b"END IONS":
+                if precursor_mz is not None:
+                    yield precursor_mz, position if scan is None else scan, spectrum_offset
+                spectrum_offset = None
+            elif upper.startswith(b"PEPMASS="):
+                precursor_mz = float(line.split(b"=", 1)[1].split()[0])
+            elif upper.startswith(b"SCANS="):
+                try:
+                    scan = int(line.split(b"=", 1)[1].strip())
+                except ValueError:
+                    pass
+
+            offset += len(line)
+
+
+def build_catalog(library_files, catalog_folder=CATALOG_FOLDER):
+    """
+    :param library_files: list of library MGF files
+    :return: number of spectra in the catalog
+    """
+    precursor_mzs = []
+    file_indices = []
+    scans = []
+    offsets = []
+
+    for file_index, filename in enumerate(library_files):
+        for precursor_mz, scan, offset in _read_mgf_index(filename):
+            precursor_mzs.append(precursor_mz)
+            file_indices.append(file_index)
+            scans.append(scan)
+            offsets.append(offset)
+
+    precursor_mzs = np.array(precursor_mzs, dtype=np.float64)
+    order = np.argsort(precursor_mzs, kind="stable")
+
+    arrays = {
+        "precursor_mz": precursor_mzs[order],
+        "file_index": np.array(file_indices, dtype=np.int32)[order],
+        "scan": np.array(scans, dtype=np.int64)[order],
+        "offset": np.array(offsets, dtype=np.int64)[order],
+    }
+
+    os.makedirs(catalog_folder, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(catalog_folder, name + ".tmp.npy"), arrays[name])
+    files = [{"file": os.path.abspath(filename), "dataset": os.path.basename(filename).split("_")[0].split(".")[0]}
+             for filename in library_files]
+    with open(os.path.join(catalog_folder, FILES_FILENAME + ".tmp"), "w") as f:
+        json.dump(files, f)
+
+    # All files are written before any is replaced, files.json last
+    for name in ARRAYS:
+        os.replace(os.path.join(catalog_folder, name + ".tmp.npy"), os.path.join(catalog_folder, name + ".npy"))
+    os.replace(os.path.join(catalog_folder, FILES_FILENAME + ".tmp"), os.path.join(catalog_folder, FILES_FILENAME))
+
+    return len(order)
+
+
+def load_catalog(catalog_folder=CATALOG_FOLDER):
+    """
+    :return: dict with the memory mapped arrays and files, None without a catalog
+    """
+    try:
+        catalog = {name: np.load(os.path.join(catalog_folder, name + ".npy"), mmap_mode="r") for name in ARRAYS}
+        with open(os.path.join(catalog_folder, FILES_FILENAME)) as f:
+            catalog["files"] = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return catalog
+
+
+def search_window(precursor_mz, analog_search="No", delta_mass_below=130, delta_mass_above=200, pm_tolerance=PM_TOLERANCE):
+    """
+    :return: (lowest, highest) library precursor m/z a query can match
+    """
+    if analog_search == "Yes":
+        return precursor_mz - delta_mass_below, precursor_mz + delta_mass_above
+
+    return precursor_mz - pm_tolerance, precursor_mz + pm_tolerance
+
+
+def window_rows(catalog, low_mz, high_mz):
+    """
+    :return: slice of the catalog rows (spectrum ids) with low_mz <= precursor m/z <= high_mz
+    """
+    start = np.searchsorted(catalog["precursor_mz"], low_mz, side="left")
+    end = np.searchsorted(catalog["precursor_mz"], high_mz, side="right")
+
+    return slice(int(start), int(end))
+
+
+def candidates(catalog, low_mz, high_mz):
+    """
+    :return: dict of arrays spectrum_id, precursor_mz, dataset, scan of the spectra in the window
+    """
+    rows = window_rows(catalog, low_mz, high_mz)
+    datasets = np.array([library_file["dataset"] for library_file in catalog["files"]], dtype=object)
+
+    return {
+        "spectrum_id": np.arange(rows.start, rows.stop),
+        "precursor_mz": np.asarray(catalog["precursor_mz"][rows]),
+        "dataset": datasets[catalog["file_index"][rows]],
+        "scan": np.asarray(catalog["scan"][rows]),
+    }
+
+
+def candidate_counts(catalog, low_mzs, high_mzs):
+    """
+    Vectorized over many windows, e.g. all queries of a batch.
+
+    :return: array with the number of candidates per window
+    """
+    starts = np.searchsorted(catalog["precursor_mz"], low_mzs, side="left")
+    ends = np.searchsorted(catalog["precursor_mz"], high_mzs, side="right")
+
+    return ends - starts
+
+
+def _read_peaks(f, offset):
+    """
+    :param f: MGF file opened in binary mode
+    :return: peaks of the spectrum at the byte offset as an (n, 2) array of m/z and intensity
+    """
+    peaks = []
+    f.seek(offset)
+    for line in f:
+        line = line.strip()
+        if line.upper() == b"END IONS":
+            break
+        if len(line) > 0 and (line[:1].isdigit() or line[:1] == b"."):
+            values = line.split()
+            peaks.append((float(values[0]), float(values[1])))
+
+    return np.array(peaks, dtype=np.float64).reshape(-1, 2)
+
+
+def read_mgf_spectra(filename):
+    """
+    :return: generator of (precursor m/z, scan, peaks as an (n, 2) array) of the spectra of an MGF file,
+             the scan is SCANS or else the position in the file
+    """
+    with open(filename, "rb") as f:
+        for precursor_mz, scan, offset in _read_mgf_index(filename):
+            yield precursor_mz, scan, _read_peaks(f, offset)
+
+
+def read_spectrum(catalog, spectrum_id):
+    """
+    :return: dict with precursor_mz, dataset, scan and peaks as an (n, 2) array of m/z and intensity
+    """
+    library_file = catalog["files"][int(catalog["file_index"][spectrum_id])]
+
+    with open(library_file["file"], "rb") as f:
+        peaks = _read_peaks(f, int(catalog["offset"][spectrum_id]))
+
+    return {
+        "precursor_mz": float(catalog["precursor_mz"][spectrum_id]),
+        "dataset": library_file["dataset"],
+        "scan": int(catalog["scan"][spectrum_id]),
+        "peaks": peaks,
+    }
+
+
+def _query_precursors(filename):
+    return np.array([precursor_mz for precursor_mz, scan, offset in _read_mgf_index(filename)], dtype=np.float64)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precursor m/z catalog of the library")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="builds the catalog from the library MGF files")
+    build_parser.add_argument("library", help="library MGF file, or a file listing them with --reference-list")
+    build_parser.add_argument("--reference-list", "-r", action="store_true", help="library is a list of MGF files")
+    build_parser.add_argument("--catalog", default=CATALOG_FOLDER, help="catalog folder")
+
+    count_parser = subparsers.add_parser("count", help="candidates per query window, for capacity planning")
+    count_parser.add_argument("queries", help="query MGF file")
+    count_parser.add_argument("--analog", action="store_true", help="analog window instead of the precursor tolerance")
+    count_parser.add_argument("--below", type=float, default=130, help="delta_mass_below of an analog search")
+    count_parser.add_argument("--above", type=float, default=200, help="delta_mass_above of an analog search")
+    count_parser.add_argument("--pm_tolerance", type=float, default=PM_TOLERANCE, help="precursor tolerance of an exact search")
+    count_parser.add_argument("--catalog", default=CATALOG_FOLDER, help="catalog folder")
+    count_parser.add_argument("--output", help="optional TSV with the candidates per query")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.reference_list:
+            with open(args.library) as f:
+                library_files = [line.strip() for line in f if len(line.strip()) > 0]
+        else:
+            library_files = [args.library]
+
+        print("Catalog", build_catalog(library_files, args.catalog), "spectra")
+    else:
+        catalog = load_catalog(args.catalog)
+        if catalog is None:
+            print("No catalog in", args.catalog, file=sys.stderr)
+            sys.exit(1)
+
+        precursor_mzs = _query_precursors(args.queries)
+        low_mzs, high_mzs = search_window(precursor_mzs, "Yes" if args.analog else "No",
+                                          args.below, args.above, args.pm_tolerance)
+        counts = candidate_counts(catalog, low_mzs, high_mzs)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write("query\tprecursor_mz\tcandidates\n")
+                for i, (precursor_mz, count) in enumerate(zip(precursor_mzs, counts), start=1):
+                    f.write("{}\t{}\t{}\n".format(i, precursor_mz, count))
+
+        print("Library spectra", len(catalog["precursor_mz"]))
+        print("Queries", len(counts))
+        if len(counts) > 0:
+            print("Candidates total", int(counts.sum()))
+            for percentile in [50, 90, 99, 100]:
+                print("Candidates p{}".format(percentile), int(np.percentile(counts, percentile)))
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+MassIVE dataset titles for the ./bin/search results, resident in the worker.
+
+The GNPS datasets of MassIVE are kept in a snapshot, temp/datasets.feather, with its version and fetch time in
+temp/datasets.json. temp is shared by all containers, so the search worker that runs the beat schedule keeps it
+up to date for every worker. sync pages through all datasets at the same time for a full sync, and afterwards
+only fetches the new ones, with a full sync again every FULL_SYNC_INTERVAL. Startup of a ./bin/search worker
+only syncs when there is no snapshot yet.
+
+Instead of reading the snapshot for every search, each worker process keeps a compact accession -> title
+lookup (categorical titles, already cut to TITLE_LENGTH) and the results are joined with one vectorized lookup.
+
+The snapshot is replaced atomically, the workers notice the new file and swap in a new lookup, so a search
+always sees either the old or the new table.
+"""
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import masst_http
+
+DATASETS_FILENAME = os.path.join("temp", "datasets.feather")
+MANIFEST_FILENAME = os.path.join("temp", "datasets.json")
+
+QUERY_DATASETS_URL = "https://massive.ucsd.edu/ProteoSAFe/QueryDatasets"
+DATASETS_QUERY = '{"title_input":"GNPS"}'
+
+# Datasets per MassIVE request and requests at the same time for a full sync
+PAGE_SIZE = int(os.environ.get("MASST_DATASETS_PAGE_SIZE", 500))
+SYNC_THREADS = int(os.environ.get("MASST_DATASETS_SYNC_THREADS", 4))
+
+# Titles of older datasets can change, everything is fetched again after a week
+FULL_SYNC_INTERVAL = int(os.environ.get("MASST_DATASETS_FULL_SYNC_INTERVAL", 7 * 24 * 3600))
+
+# Titles are shown in a table, longer ones are cut
+TITLE_LENGTH = 40
+
+# How often a worker looks for a new datasets file
+REFRESH_CHECK_INTERVAL = 300
+
+_lookup = None
+_loaded_mtime = None
+_last_check = 0
+_load_lock = threading.Lock()
+
+
+def _build_lookup(datasets_df):
+    titles = datasets_df["title"].astype(str).str.slice(0, TITLE_LENGTH)
+
+    lookup = pd.Series(pd.Categorical(titles), index=pd.Index(datasets_df["dataset"].astype(str), name="dataset"))
+
+    return lookup[~lookup.index.duplicated()]
+
+
+def _read_snapshot(filename, columns=None):
+    import pyarrow.feather
+
+    # The snapshot is written uncompressed, so it is mapped instead of read
+    return pyarrow.feather.read_table(filename, columns=columns, memory_map=True).to_pandas()
+
+
+def load(filename=DATASETS_FILENAME):
+    """
+    Builds the lookup from the datasets file, the previous lookup stays in use until the new one is ready.
+    """
+    global _lookup, _loaded_mtime, _last_check
+
+    with _load_lock:
+        try:
+            mtime = os.path.getmtime(filename)
+            lookup = _build_lookup(_read_snapshot(filename, columns=["dataset", "title"]))
+        except Exception as e:
+            print("Could not load datasets", filename, repr(e), file=sys.stderr, flush=True)
+            return
+
+        _lookup = lookup
+        _loaded_mtime = mtime
+        _last_check = time.time()
+
+    print("Datasets loaded", len(lookup), file=sys.stderr, flush=True)
+
+
+def save(datasets_df, filename=DATASETS_FILENAME):
+    """
+    Writes a new datasets file without the workers ever seeing a half written one, and loads it.
+    """
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    datasets_df.reset_index(drop=True).to_feather(temp_filename, compression="uncompressed")
+    os.replace(temp_filename, filename)
+
+    load(filename)
+
+
+def read_manifest(filename=MANIFEST_FILENAME):
+    """
+    :return: dict with version, fetched, full_sync (unix times), datasets and new (None after a full sync), None without a snapshot
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest, filename=MANIFEST_FILENAME):
+    temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temp_filename, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temp_filename, filename)
+
+
+def has_snapshot():
+    return os.path.exists(DATASETS_FILENAME) and read_manifest() is not None
+
+
+def _fetch_page(session, offset):
+    """
+    :return: rows of the page and the total number of datasets, None if MassIVE does not say
+    """
+    response = masst_http.get(QUERY_DATASETS_URL, session=session, timeout=(5, 300),
+                              params={"pageSize": PAGE_SIZE, "offset": offset, "query": DATASETS_QUERY})
+    response.raise_for_status()
+    page = response.json()
+
+    total_rows = page.get("total_rows")
+
+    return page["row_data"], None if total_rows is None else int(total_rows)
+
+
+def _fetch_all(session):
+    rows, total_rows = _fetch_page(session, 0)
+
+    if total_rows is None:
+        # Page by page until a short one
+        offset = 0
+        page_rows = rows
+        while len(page_rows) == PAGE_SIZE:
+            offset += PAGE_SIZE
+            page_rows, _ = _fetch_page(session, offset)
+            rows.extend(page_rows)
+
+        return rows, total_rows
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_THREADS) as executor:
+        offsets = range(PAGE_SIZE, total_rows, PAGE_SIZE)
+        for page_rows, _ in executor.map(lambda offset: _fetch_page(session, offset), offsets):
+            rows.extend(page_rows)
+
+    return rows, total_rows
+
+
+def _fetch_new(session, known_datasets):
+    """
+    MassIVE lists the newest datasets first, pages until one has no new dataset.
+    """
+    rows = []
+    offset = 0
+    while True:
+        page_rows, total_rows = _fetch_page(session, offset)
+        new_rows = [row for row in page_rows if row.get("dataset") not in known_datasets]
+        rows.extend(new_rows)
+
+        if len(new_rows) < len(page_rows) or len(page_rows) < PAGE_SIZE:
+            return rows, total_rows
+
+        offset += PAGE_SIZE
+
+
+def sync(full=False):
+    """
+    Fetches the new datasets into the snapshot, or all of them without a recent full sync.
+
+    :return: manifest of the new snapshot
+    """
+    manifest = read_manifest()
+    fetch_time = time.time()
+    # The cache of install_cache would hand back the pages of the previous sync
+    session = masst_http.new_uncached_session()
+
+    datasets_df = None
+    new_datasets = None
+    if not full and manifest is not None and fetch_time - manifest["full_sync"] < FULL_SYNC_INTERVAL:
+        try:
+            current_df = _read_snapshot(DATASETS_FILENAME)
+        except Exception as e:
+            print("Could not read datasets", repr(e), file=sys.stderr, flush=True)
+        else:
+            new_rows, total_rows = _fetch_new(session, set(current_df["dataset"]))
+            datasets_df = pd.concat([pd.DataFrame(new_rows), current_df]).drop_duplicates("dataset")
+            new_datasets = len(new_rows)
+
+            # Deleted datasets, or new ones that were not listed first
+            if total_rows is not None and total_rows != len(datasets_df):
+                print("Datasets", len(datasets_df), "MassIVE", total_rows, "full sync", file=sys.stderr, flush=True)
+                datasets_df = None
+
+    if datasets_df is None:
+        rows, total_rows = _fetch_all(session)
+        datasets_df = pd.DataFrame(rows).drop_duplicates("dataset")
+        full_sync_time = fetch_time
+        new_datasets = None
+    else:
+        full_sync_time = manifest["full_sync"]
+
+    save(datasets_df)
+
+    manifest = {
+        "version": (manifest or {}).get("version", 0) + 1,
+        "fetched": fetch_time,
+        "full_sync": full_sync_time,
+        "datasets": len(datasets_df),
+        "new": new_datasets,
+    }
+    _write_manifest(manifest)
+
+    print("Datasets synced", manifest, file=sys.stderr, flush=True)
+
+    return manifest
+
+
+def refresh_if_changed(filename=DATASETS_FILENAME):
+    global _last_check
+
+    if _lookup is not None and time.time() - _last_check < REFRESH_CHECK_INTERVAL:
+        return
+
+    _last_check = time.time()
+
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return
+
+    if mtime != _loaded_mtime:
+        load(filename)
+
+
+def accessions(db_files):
+    """
+    Dataset accession of the library files in the ./bin/search results, e.g. .../MSV000084314_xyz.mgf -> MSV000084314
+
+    :param db_files: series of DB File paths
+    """
+    return db_files.astype(str).str.rsplit("/", n=1).str[-1].str.split("_", n=1).str[0]
+
+
+def titles(dataset_accessions):
+    """
+    :param dataset_accessions: series of accessions
+    :return: array of titles, "nan" for unknown datasets as before
+    """
+    refresh_if_changed()
+
+    if _lookup is None:
+        return ["nan"] * len(dataset_accessions)
+
+    return _lookup.reindex(dataset_accessions.astype(str)).astype(object).fillna("nan").to_numpy()
+
+
+def dataset_count():
+    return 0 if _lookup is None else len(_lookup)
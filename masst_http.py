@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP client for the outbound calls (metabolomics-usi.gnps2.org, gnps.ucsd.edu, proteomics2.ucsd.edu,
+massive.ucsd.edu, ...).
+
+One pooled keep-alive session per process, so repeated calls to the same host reuse the TLS connection
+instead of doing a new handshake every time. Every call gets a default timeout, idempotent calls are retried
+with jittered exponential backoff, and the latency per host is recorded for http_stats.
+"""
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection pools kept per session (one per host) and open connections per host
+HOST_POOLS = int(os.environ.get("MASST_HTTP_HOST_POOLS", 16))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get("MASST_HTTP_MAX_CONNECTIONS_PER_HOST", 10))
+
+# (connect, read) in seconds, used unless a call passes its own timeout
+DEFAULT_TIMEOUT = (5, 60)
+
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+_session = None
+_session_lock = threading.Lock()
+# Set by install_cache
+_cache_config = None
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _retry():
+    retry_arguments = {
+        "total": RETRIES,
+        "backoff_factor": RETRY_BACKOFF,
+        "status_forcelist": RETRY_STATUS,
+        # Never retry POSTs, e.g. launching a GNPS workflow twice
+        "allowed_methods": ["HEAD", "GET", "OPTIONS"],
+        "respect_retry_after_header": True,
+        "raise_on_status": False,
+    }
+
+    try:
+        # urllib3 2, so the workers do not retry in lockstep
+        return Retry(backoff_jitter=RETRY_BACKOFF, **retry_arguments)
+    except TypeError:
+        return Retry(**retry_arguments)
+
+
+def configure_session(session):
+    """
+    Mounts the pooled, retrying adapters on a session. Use this for sessions that need their own cookies.
+    """
+    # pool_block caps the connections per host, extra threads wait for a free one
+    adapter = HTTPAdapter(pool_connections=HOST_POOLS, pool_maxsize=MAX_CONNECTIONS_PER_HOST,
+                          pool_block=True, max_retries=_retry())
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def new_session():
+    return configure_session(requests.Session())
+
+
+def new_uncached_session():
+    """
+    A pooled session that always asks the server, also after install_cache.
+    """
+    if _cache_config is None:
+        return new_session()
+
+    import requests_cache
+
+    with requests_cache.disabled():
+        return new_session()
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                if _cache_config is not None:
+                    import requests_cache
+                    _session = configure_session(requests_cache.CachedSession(**_cache_config))
+                else:
+                    _session = new_session()
+
+    return _session
+
+
+def install_cache(cache_name, expire_after):
+    """
+    Caches the responses of the shared session (and of plain requests calls) with requests_cache.
+    """
+    global _session, _cache_config
+
+    import requests_cache
+
+    requests_cache.install_cache(cache_name, expire_after=expire_after)
+
+    with _session_lock:
+        _cache_config = {"cache_name": cache_name, "expire_after": expire_after}
+        _session = None
+
+
+def _reset_after_fork():
+    # Connections of the parent must not be shared with the forked workers, get_session opens new ones
+    global _session, _session_lock, _stats_lock
+
+    _session = None
+    _session_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _record(host, duration, failed, retries):
+    with _stats_lock:
+        host_stats = _stats.setdefault(host, {"requests": 0, "errors": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        host_stats["requests"] += 1
+        host_stats["errors"] += 1 if failed else 0
+        host_stats["retries"] += retries
+        host_stats["total_seconds"] += duration
+        host_stats["max_seconds"] = max(host_stats["max_seconds"], duration)
+
+
+def request(method, url, session=None, **kwargs):
+    """
+    Same as requests.request, on the shared session with the default timeout.
+
+    :param session: optional session from new_session, e.g. for a login
+    """
+    if session is None:
+        session = get_session()
+
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+
+    host = urllib.parse.urlsplit(url).netloc
+    start_time = time.time()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        _record(host, time.time() - start_time, True, 0)
+        print("HTTP failed", method, url, repr(e), file=sys.stderr, flush=True)
+        raise
+
+    retries = 0
+    try:
+        retries = len(response.raw.retries.history)
+    except AttributeError:
+        pass
+
+    _record(host, time.time() - start_time, response.status_code >= 400, retries)
+
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def http_stats():
+    """
+    :return: per host request count, errors, retries and latency of this process
+    """
+    with _stats_lock:
+        return {
+            host: dict(host_stats, mean_seconds=host_stats["total_seconds"] / host_stats["requests"])
+            for host, host_stats in _stats.items()
+        }
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Fragment ion inverted index of the library, a search engine in numpy next to ./bin/search.
+
+Built from the same MGF inputs as ./bin/load (one MGF file, or a list of them with -r). The spectra are
+ordered by precursor m/z, so a precursor window is a range of spectrum ids, and stored with two posting lists:
+
+    fragment m/z bin   -> spectra with a peak in the bin
+    neutral loss bin   -> spectra with a peak at that distance below their precursor
+
+A shifted (analog) match is a peak with the same neutral loss, so both exact and analog candidates come from
+the posting lists, only the candidates are then scored with masst_scoring. Everything is .npy arrays in
+bin/fragment_index that are memory mapped:
+
+    python masst_index.py build library_list.txt -r
+    python masst_index.py search query.mgf -o results.tsv -a
+
+search writes the same columns as ./bin/search (Query File, Query Scan, DB File, DB Scan, Score,
+Matched Peaks, M/Z Delta), M/Z Delta is the library minus the query precursor m/z.
+
+The ./bin/search worker keeps the index loaded with resident_index, it is mapped before the pool forks so
+every worker child searches the same pages in memory, and is loaded again when a new index is built.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import masst_catalog
+import masst_scoring
+
+INDEX_FOLDER = os.path.join("bin", "fragment_index")
+INDEX_FILENAME = "index.json"
+
+ARRAYS = ["precursor_mz", "file_index", "scan", "peak_indptr", "peak_mz", "peak_intensity",
+          "fragment_indptr", "fragment_spectrum", "loss_indptr", "loss_spectrum"]
+
+BIN_WIDTH = 0.01
+
+# Most intense peaks kept per library spectrum, bounds the posting lists
+MAX_PEAKS = int(os.environ.get("MASST_INDEX_MAX_PEAKS", 100))
+
+MIN_COSINE = 0.7
+MIN_MATCHED_PEAKS = 6
+
+# Columns of the ./bin/search results, search_rows writes the same
+RESULT_COLUMNS = ["Query File", "Query Scan", "DB File", "DB Scan", "Score", "Matched Peaks", "M/Z Delta"]
+
+# How often a worker looks for a new index
+RESIDENT_CHECK_INTERVAL = 60
+
+_resident = {"index": None, "mtime": None, "last_check": 0}
+_resident_lock = threading.Lock()
+
+
+def _top_peaks(peaks, max_peaks):
+    if len(peaks) > max_peaks:
+        peaks = peaks[np.argsort(-peaks[:, 1], kind="stable")[:max_peaks]]
+
+    return peaks[np.argsort(peaks[:, 0], kind="stable")]
+
+
+def _posting_lists(bins, spectra, bin_count):
+    """
+    :return: indptr per bin and the spectra of every bin, sorted and without duplicates
+    """
+    order = np.lexsort((spectra, bins))
+    bins = bins[order]
+    spectra = spectra[order]
+
+    unique = np.ones(len(bins), dtype=bool)
+    unique[1:] = (bins[1:] != bins[:-1]) | (spectra[1:] != spectra[:-1])
+    bins = bins[unique]
+    spectra = spectra[unique]
+
+    indptr = np.zeros(bin_count + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(bins, minlength=bin_count))
+
+    return indptr, spectra.astype(np.int32)
+
+
+def build_index(library_files, index_folder=INDEX_FOLDER, max_peaks=MAX_PEAKS, bin_width=BIN_WIDTH):
+    """
+    :param library_files: list of library MGF files
+    :return: number of spectra in the index
+    """
+    precursor_mzs = []
+    file_indices = []
+    scans = []
+    peaks_list = []
+
+    for file_index, filename in enumerate(library_files):
+        for precursor_mz, scan, peaks in masst_catalog.read_mgf_spectra(filename):
+            precursor_mzs.append(precursor_mz)
+            file_indices.append(file_index)
+            scans.append(scan)
+            peaks_list.append(_top_peaks(peaks, max_peaks))
+
+    # Spectrum ids in precursor m/z order
+    order = np.argsort(np.array(precursor_mzs, dtype=np.float64), kind="stable")
+    precursor_mzs = np.array(precursor_mzs, dtype=np.float64)[order]
+    peak_mz, peak_intensity, peak_indptr = masst_scoring.to_csr([peaks_list[i] for i in order])
+
+    peak_spectrum = np.repeat(np.arange(len(order)), np.diff(peak_indptr))
+    losses = precursor_mzs[peak_spectrum] - peak_mz
+    has_loss = losses >= 0
+
+    fragment_bins = np.floor(peak_mz / bin_width).astype(np.int64)
+    loss_bins = np.floor(losses[has_loss] / bin_width).astype(np.int64)
+    bin_count = int(max(fragment_bins.max(initial=0), loss_bins.max(initial=0))) + 1
+
+    fragment_indptr, fragment_spectrum = _posting_lists(fragment_bins, peak_spectrum, bin_count)
+    loss_indptr, loss_spectrum = _posting_lists(loss_bins, peak_spectrum[has_loss], bin_count)
+
+    arrays = {
+        "precursor_mz": precursor_mzs,
+        "file_index": np.array(file_indices, dtype=np.int32)[order],
+        "scan": np.array(scans, dtype=np.int64)[order],
+        "peak_indptr": peak_indptr,
+        "peak_mz": peak_mz,
+        "peak_intensity": peak_intensity,
+        "fragment_indptr": fragment_indptr,
+        "fragment_spectrum": fragment_spectrum,
+        "loss_indptr": loss_indptr,
+        "loss_spectrum": loss_spectrum,
+    }
+
+    os.makedirs(index_folder, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(index_folder, name + ".tmp.npy"), arrays[name])
+    with open(os.path.join(index_folder, INDEX_FILENAME + ".tmp"), "w") as f:
+        json.dump({"bin_width": bin_width, "max_peaks": max_peaks, "spectra": len(order),
+                   "files": [os.path.abspath(filename) for filename in library_files]}, f)
+
+    # All files are written before any is replaced, index.json last
+    for name in ARRAYS:
+        os.replace(os.path.join(index_folder, name + ".tmp.npy"), os.path.join(index_folder, name + ".npy"))
+    os.replace(os.path.join(index_folder, INDEX_FILENAME + ".tmp"), os.path.join(index_folder, INDEX_FILENAME))
+
+    return len(order)
+
+
+def load_index(index_folder=INDEX_FOLDER):
+    """
+    :return: dict with the memory mapped arrays and the index.json entries, None without an index
+    """
+    try:
+        with open(os.path.join(index_folder, INDEX_FILENAME)) as f:
+            index = json.load(f)
+        for name in ARRAYS:
+            index[name] = np.load(os.path.join(index_folder, name + ".npy"), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+
+    return index
+
+
+def resident_index(index_folder=INDEX_FOLDER):
+    """
+    The index kept by this worker process, loaded on the first call and again when index.json changes,
+    checked at most every RESIDENT_CHECK_INTERVAL seconds.
+
+    :return: index dict, None without an index
+    """
+    with _resident_lock:
+        if _resident["index"] is not None and time.time() - _resident["last_check"] < RESIDENT_CHECK_INTERVAL:
+            return _resident["index"]
+
+        _resident["last_check"] = time.time()
+
+        try:
+            mtime = os.path.getmtime(os.path.join(index_folder, INDEX_FILENAME))
+        except OSError:
+            _resident["index"] = None
+            _resident["mtime"] = None
+            return None
+
+        if mtime != _resident["mtime"]:
+            index = load_index(index_folder)
+            if index is not None:
+                print("Loaded index", index_folder, index["spectra"], "spectra", file=sys.stderr, flush=True)
+                _resident["index"] = index
+                _resident["mtime"] = mtime
+
+        return _resident["index"]
+
+
+def _postings(index, indptr_name, spectrum_name, values, tolerance, first_spectrum, end_spectrum):
+    """
+    :return: (value index, spectrum) pairs of the posting lists within the tolerance of each value,
+             only spectra in [first_spectrum, end_spectrum)
+    """
+    indptr = index[indptr_name]
+    bin_count = len(indptr) - 1
+    first_bins = np.clip(np.floor((values - tolerance) / index["bin_width"]).astype(np.int64), 0, bin_count)
+    end_bins = np.clip(np.floor((values + tolerance) / index["bin_width"]).astype(np.int64) + 1, 0, bin_count)
+
+    value_indices = []
+    spectra = []
+    for i, (first_bin, end_bin) in enumerate(zip(first_bins, end_bins)):
+        posting = np.asarray(index[spectrum_name][indptr[first_bin]:indptr[end_bin]])
+        posting = posting[(posting >= first_spectrum) & (posting < end_spectrum)]
+        value_indices.append(np.full(len(posting), i))
+        spectra.append(posting)
+
+    if len(spectra) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    return np.concatenate(value_indices), np.concatenate(spectra)
+
+
+def candidates(index, query_peaks, query_precursor_mz, analog_search="No", tolerance=masst_scoring.FRAGMENT_TOLERANCE,
+               min_matched_peaks=MIN_MATCHED_PEAKS, delta_mass_below=130, delta_mass_above=200):
+    """
+    :return: spectrum ids in the precursor window that share at least min_matched_peaks query peaks
+    """
+    low_mz, high_mz = masst_catalog.search_window(query_precursor_mz, analog_search, delta_mass_below, delta_mass_above)
+    window = masst_catalog.window_rows(index, low_mz, high_mz)
+
+    query_mz = query_peaks[:, 0]
+    peak_indices, spectra = _postings(index, "fragment_indptr", "fragment_spectrum", query_mz, tolerance,
+                                      window.start, window.stop)
+
+    if analog_search == "Yes":
+        loss_peak_indices, loss_spectra = _postings(index, "loss_indptr", "loss_spectrum",
+                                                    query_precursor_mz - query_mz, tolerance, window.start, window.stop)
+        peak_indices = np.concatenate([peak_indices, loss_peak_indices])
+        spectra = np.concatenate([spectra, loss_spectra])
+
+    # Every query peak matches at most one library peak, so distinct query peaks bound the matched peaks
+    pairs = np.unique(spectra.astype(np.int64) * max(len(query_mz), 1) + peak_indices)
+    candidate_spectra, shared_peaks = np.unique(pairs // max(len(query_mz), 1), return_counts=True)
+
+    return candidate_spectra[shared_peaks >= min_matched_peaks]
+
+
+def search(index, query_peaks, query_precursor_mz, analog_search="No", tolerance=masst_scoring.FRAGMENT_TOLERANCE,
+           min_cosine=MIN_COSINE, min_matched_peaks=MIN_MATCHED_PEAKS, delta_mass_below=130, delta_mass_above=200):
+    """
+    :param query_peaks: (n, 2) array or list of [m/z, intensity]
+    :return: list of dicts with spectrum_id, file, scan, score, matched_peaks and mz_delta, best score first
+    """
+    query_peaks = np.asarray(query_peaks, dtype=np.float64).reshape(-1, 2)
+    candidate_spectra = candidates(index, query_peaks, query_precursor_mz, analog_search, tolerance,
+                                   min_matched_peaks, delta_mass_below, delta_mass_above)
+    if len(candidate_spectra) == 0:
+        return []
+
+    # Peaks of the candidates as their own CSR arrays
+    peak_indptr = index["peak_indptr"]
+    starts = peak_indptr[candidate_spectra]
+    counts = peak_indptr[candidate_spectra + 1] - starts
+    indptr = np.zeros(len(candidate_spectra) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    peaks = np.repeat(starts - indptr[:-1], counts) + np.arange(indptr[-1])
+
+    precursor_mzs = np.asarray(index["precursor_mz"][candidate_spectra])
+    scores = masst_scoring.score(query_peaks, query_precursor_mz, index["peak_mz"][peaks], index["peak_intensity"][peaks],
+                                 indptr, precursor_mzs=precursor_mzs, shifted=analog_search == "Yes", tolerance=tolerance)
+
+    hits = np.flatnonzero((scores["score"] >= min_cosine) & (scores["matched_peaks"] >= min_matched_peaks))
+    hits = hits[np.argsort(-scores["score"][hits], kind="stable")]
+
+    return [{
+        "spectrum_id": int(candidate_spectra[hit]),
+        "file": index["files"][int(index["file_index"][candidate_spectra[hit]])],
+        "scan": int(index["scan"][candidate_spectra[hit]]),
+        "score": float(scores["score"][hit]),
+        "matched_peaks": int(scores["matched_peaks"][hit]),
+        "mz_delta": float(precursor_mzs[hit] - query_precursor_mz),
+    } for hit in hits]
+
+
+def search_rows(index, spectra, analog_search="No", query_file="query.mgf"):
+    """
+    Searches a batch like ./bin/search does, the scan of a spectrum is its position starting at 1.
+
+    :param spectra: list of dicts with precursor_mz and peaks, None entries are skipped
+    :return: rows with RESULT_COLUMNS
+    """
+    rows = []
+    for scan, spectrum in enumerate(spectra, start=1):
+        if spectrum is None:
+            continue
+
+        for hit in search(index, spectrum["peaks"], spectrum["precursor_mz"], analog_search):
+            rows.append([query_file, scan, hit["file"], hit["scan"], hit["score"], hit["matched_peaks"], hit["mz_delta"]])
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fragment ion inverted index of the library")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="builds the index from the library MGF files")
+    build_parser.add_argument("library", help="library MGF file, or a file listing them with --reference-list")
+    build_parser.add_argument("--reference-list", "-r", action="store_true", help="library is a list of MGF files")
+    build_parser.add_argument("--index", "-l", default=INDEX_FOLDER, help="index folder")
+    build_parser.add_argument("--max_peaks", type=int, default=MAX_PEAKS, help="most intense peaks kept per spectrum")
+
+    search_parser = subparsers.add_parser("search", help="searches the spectra of an MGF file, like ./bin/search")
+    search_parser.add_argument("query", help="query MGF file")
+    search_parser.add_argument("--output", "-o", default="matches-all.tsv", help="results TSV")
+    search_parser.add_argument("--index", "-l", default=INDEX_FOLDER, help="index folder")
+    search_parser.add_argument("--analog", "-a", action="store_true", help="analog search")
+    search_parser.add_argument("--peaktol", "-p", type=float, default=masst_scoring.FRAGMENT_TOLERANCE, help="fragment tolerance")
+    search_parser.add_argument("--thresh", "-t", type=float, default=MIN_COSINE, help="minimum score")
+    search_parser.add_argument("--min_matched_peaks", type=int, default=MIN_MATCHED_PEAKS, help="minimum matched peaks")
+    search_parser.add_argument("--below", type=float, default=130, help="delta_mass_below of an analog search")
+    search_parser.add_argument("--above", type=float, default=200, help="delta_mass_above of an analog search")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.reference_list:
+            with open(args.library) as f:
+                library_files = [line.strip() for line in f if len(line.strip()) > 0]
+        else:
+            library_files = [args.library]
+
+        start_time = time.time()
+        spectrum_count = build_index(library_files, args.index, max_peaks=args.max_peaks)
+        print("Index", spectrum_count, "spectra in", time.time() - start_time)
+    else:
+        index = load_index(args.index)
+        if index is None:
+            print("No index in", args.index, file=sys.stderr)
+            sys.exit(1)
+
+        start_time = time.time()
+        query_count = 0
+        with open(args.output, "w") as f:
+            f.write("\t".join(RESULT_COLUMNS) + "\n")
+            for precursor_mz, scan, peaks in masst_catalog.read_mgf_spectra(args.query):
+                query_count += 1
+                for hit in search(index, peaks, precursor_mz, "Yes" if args.analog else "No", args.peaktol,
+                                  args.thresh, args.min_matched_peaks, args.below, args.above):
+                    f.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(args.query, scan, hit["file"], hit["scan"], hit["score"],
+                                                                  hit["matched_peaks"], hit["mz_delta"]))
+
+        print("Searched", query_count, "spectra in", time.time() - start_time, file=sys.stderr)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Garbage collection for the search folders in temp/microbemasst, run hourly as a celery beat task.
+
+Two quotas, both configurable from the environment:
+
+- age: folders that nobody used for MASST_JANITOR_MAX_AGE_HOURS are removed
+- total size: if temp/microbemasst is still above MASST_JANITOR_MAX_TOTAL_MB, the least recently
+  used folders are removed until it fits
+
+Never removed: pinned folders (a "pinned" file in the folder), searches in flight and folders
+used within the last MIN_IDLE_SECONDS. Folders with a live result cache entry are only removed
+by the size quota, after every folder without one, and their cache entry goes with them.
+"""
+import os
+import shutil
+import sys
+import time
+import uuid
+
+import masst_search
+
+MAX_AGE_HOURS = float(os.environ.get("MASST_JANITOR_MAX_AGE_HOURS", 7 * 24))
+MAX_TOTAL_MB = float(os.environ.get("MASST_JANITOR_MAX_TOTAL_MB", 20000))
+
+# Protects searches that were just submitted or are still being looked at
+MIN_IDLE_SECONDS = 3600
+
+# Create this file in a search folder to keep it forever, e.g. for results linked from a paper
+PIN_FILENAME = "pinned"
+
+# Folders are renamed to this prefix before deleting, so a new search never lands in a half deleted folder
+TRASH_PREFIX = "deleting_"
+
+JANITOR_TOTALS_KEY = "masst_janitor_totals"
+JANITOR_LAST_RUN_KEY = "masst_janitor_last_run"
+
+
+def _folder_size(folder):
+    total_bytes = 0
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            try:
+                total_bytes += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+
+    return total_bytes
+
+
+def _last_used(folder):
+    """
+    Most recent of the folder itself, its direct entries and its watcher files. Pages polling a search
+    touch their watcher file and cache hits touch the folder.
+    """
+    last_used = os.path.getmtime(folder)
+
+    watchers_folder = os.path.join(folder, masst_search.WATCHERS_FOLDERNAME)
+    for entries_folder in [folder, watchers_folder]:
+        try:
+            for entry in os.scandir(entries_folder):
+                try:
+                    last_used = max(last_used, entry.stat(follow_symlinks=False).st_mtime)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+
+    return last_used
+
+
+def _protected(folder, last_used, now):
+    if os.path.isfile(os.path.join(folder, PIN_FILENAME)):
+        return True
+
+    # A claim older than the celery time limit is from a killed worker
+    inflight_filename = os.path.join(folder, masst_search.INFLIGHT_FILENAME)
+    try:
+        if now - os.path.getmtime(inflight_filename) < masst_search.claim_time_limit(inflight_filename):
+            return True
+    except OSError:
+        pass
+
+    return now - last_used < MIN_IDLE_SECONDS
+
+
+def _remove_folder(folder):
+    """
+    :return: True if the folder is gone
+    """
+    trash_folder = os.path.join(os.path.dirname(folder), TRASH_PREFIX + uuid.uuid4().hex)
+    try:
+        os.rename(folder, trash_folder)
+    except OSError:
+        return False
+
+    shutil.rmtree(trash_folder, ignore_errors=True)
+
+    return True
+
+
+def list_search_folders(output_root=masst_search.OUTPUT_ROOT):
+    """
+    :return: list of dicts with task, folder, size_bytes, last_used and cached, empty without output_root
+    """
+    # Nothing searched yet on a fresh deploy
+    if not os.path.isdir(output_root):
+        return []
+
+    search_folders = []
+    for entry in os.scandir(output_root):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+
+        try:
+            search_folders.append({
+                "task": entry.name,
+                "folder": entry.path,
+                "size_bytes": _folder_size(entry.path),
+                "last_used": _last_used(entry.path),
+                "cached": masst_search.result_cache.get(entry.name) is not None,
+            })
+        except OSError:
+            # Removed while we were looking at it
+            pass
+
+    return search_folders
+
+
+def cleanup(output_root=masst_search.OUTPUT_ROOT, max_age_hours=MAX_AGE_HOURS, max_total_mb=MAX_TOTAL_MB, dry_run=False):
+    """
+    Applies the age and total size quotas to the search folders.
+
+    :param dry_run: only report what would be removed
+    :return: dict with the folders and bytes removed and what is left
+    """
+    start_time = time.time()
+    now = time.time()
+    max_total_bytes = max_total_mb * 1024 * 1024
+
+    search_folders = list_search_folders(output_root)
+    total_bytes = sum(search_folder["size_bytes"] for search_folder in search_folders)
+
+    removed_folders = 0
+    reclaimed_bytes = 0
+
+    def remove(search_folder):
+        nonlocal removed_folders, reclaimed_bytes, total_bytes
+
+        if dry_run:
+            removed = True
+        elif search_folder["task"].startswith(TRASH_PREFIX):
+            shutil.rmtree(search_folder["folder"], ignore_errors=True)
+            removed = True
+        else:
+            removed = _remove_folder(search_folder["folder"])
+
+        if removed:
+            if search_folder["cached"] and not dry_run:
+                masst_search.result_cache.delete(search_folder["task"])
+
+            removed_folders += 1
+            reclaimed_bytes += search_folder["size_bytes"]
+            total_bytes -= search_folder["size_bytes"]
+
+    candidates = []
+    for search_folder in search_folders:
+        # Leftovers from a janitor run that died halfway
+        if search_folder["task"].startswith(TRASH_PREFIX):
+            remove(search_folder)
+            continue
+
+        if _protected(search_folder["folder"], search_folder["last_used"], now):
+            continue
+
+        if not search_folder["cached"] and now - search_folder["last_used"] > max_age_hours * 3600:
+            remove(search_folder)
+            continue
+
+        candidates.append(search_folder)
+
+    # Least recently used first, cached results only once nothing else is left
+    candidates = sorted(candidates, key=lambda search_folder: (search_folder["cached"], search_folder["last_used"]))
+    for search_folder in candidates:
+        if total_bytes <= max_total_bytes:
+            break
+
+        remove(search_folder)
+
+    stats = {
+        "removed_folders": removed_folders,
+        "reclaimed_bytes": reclaimed_bytes,
+        "remaining_folders": len(search_folders) - removed_folders,
+        "remaining_bytes": total_bytes,
+        "over_quota": total_bytes > max_total_bytes,
+        "duration": time.time() - start_time,
+        "finished": time.time(),
+        "dry_run": dry_run,
+    }
+
+    if not dry_run:
+        _record_stats(stats)
+
+    print("Janitor", stats, file=sys.stderr, flush=True)
+
+    return stats
+
+
+def _record_stats(stats):
+    totals = masst_search.result_cache.get(JANITOR_TOTALS_KEY) or {"runs": 0, "removed_folders": 0, "reclaimed_bytes": 0}
+    totals["runs"] += 1
+    totals["removed_folders"] += stats["removed_folders"]
+    totals["reclaimed_bytes"] += stats["reclaimed_bytes"]
+
+    masst_search.result_cache.set(JANITOR_TOTALS_KEY, totals)
+    masst_search.result_cache.set(JANITOR_LAST_RUN_KEY, stats)
+
+
+def janitor_stats():
+    return {
+        "totals": masst_search.result_cache.get(JANITOR_TOTALS_KEY) or {"runs": 0, "removed_folders": 0, "reclaimed_bytes": 0},
+        "last_run": masst_search.result_cache.get(JANITOR_LAST_RUN_KEY),
+        "max_age_hours": MAX_AGE_HOURS,
+        "max_total_mb": MAX_TOTAL_MB,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cleans up temp/microbemasst")
+    parser.add_argument("--max_age_hours", type=float, default=MAX_AGE_HOURS)
+    parser.add_argument("--max_total_mb", type=float, default=MAX_TOTAL_MB)
+    parser.add_argument("--dry_run", action="store_true")
+    args = parser.parse_args()
+
+    cleanup(max_age_hours=args.max_age_hours, max_total_mb=args.max_total_mb, dry_run=args.dry_run)
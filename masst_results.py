@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Compact format for the ./bin/search results that go through the celery result backend.
+
+Instead of one dict per match, each repeating every column name, the results are stored column by column
+and the accessions and titles, which repeat a lot, as codes into a list of their distinct values:
+
+    {"rows": 2, "names": ["Accession", "title", "DB Scan", ...],
+     "columns": {"Accession": [0, 0], "title": [0, 0], "DB Scan": [12, 40], ...},
+     "dictionaries": {"Accession": ["MSV000084314"], "title": ["GNPS - ..."]}}
+
+It stays plain JSON, so the celery serializer does not change.
+"""
+import pandas as pd
+
+DICTIONARY_COLUMNS = ["Accession", "title"]
+
+
+def encode(results_df, dictionary_columns=DICTIONARY_COLUMNS):
+    """
+    :param results_df: formatted search results
+    :return: payload for the result backend
+    """
+    columns = {}
+    dictionaries = {}
+    for name in results_df.columns:
+        if name in dictionary_columns:
+            codes, values = pd.factorize(results_df[name])
+            columns[name] = codes.tolist()
+            dictionaries[name] = values.tolist()
+        else:
+            columns[name] = results_df[name].tolist()
+
+    return {
+        "rows": len(results_df),
+        "names": list(results_df.columns),
+        "columns": columns,
+        "dictionaries": dictionaries,
+    }
+
+
+def decode(payload):
+    """
+    :return: DataFrame of the results, also for results still stored as a list of records
+    """
+    if isinstance(payload, list):
+        return pd.DataFrame(payload)
+
+    data = {}
+    for name in payload["names"]:
+        column = payload["columns"][name]
+        if name in payload["dictionaries"]:
+            # pd.factorize marks missing values with -1
+            column = pd.Categorical.from_codes(column, categories=payload["dictionaries"][name])
+        data[name] = column
+
+    return pd.DataFrame(data, columns=payload["names"])
+
+
+def to_records(payload):
+    """
+    :return: list of dicts, e.g. for a dash DataTable
+    """
+    if isinstance(payload, list):
+        return payload
+
+    return decode(payload).astype(object).to_dict(orient="records")
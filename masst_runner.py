@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the expensive MASST work (microbe_masst searches, ./bin/search) with the same limits everywhere:
+wall clock timeout, resident memory cap, a global concurrency cap shared by all worker processes
+and cancellation. Every run reports its exit status and duration.
+
+run_command starts an external program from an argument list, without a shell, and kills it when
+a limit is hit. run_command_with_pipes does the same for programs that read and write files, and streams
+their input and output through named pipes instead of files on disk. run_in_process calls a python function in the current (warm) worker process, a
+watchdog thread interrupts it when a limit is hit, so microbe_masst keeps its imported modules
+and cached tables between searches.
+"""
+import fcntl
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Global cap on concurrent runs across all workers of this container, temp is shared so the slots are per host name
+MAX_CONCURRENT_RUNS = int(os.environ.get("MASST_MAX_CONCURRENT_RUNS", 4))
+SLOTS_FOLDER = os.path.join("temp", "runner_slots", socket.gethostname())
+
+# Memory all concurrent runs of a container may add together, the container has a 4000M limit and
+# the warm worker processes need the rest of it
+MEMORY_BUDGET_MB = int(os.environ.get("MASST_MEMORY_BUDGET_MB", 2400))
+
+# Per run defaults, every slot gets its share of the budget so the runs together stay within it
+DEFAULT_TIMEOUT = 600
+DEFAULT_MAX_MEMORY_MB = int(os.environ.get("MASST_MAX_MEMORY_MB", MEMORY_BUDGET_MB // MAX_CONCURRENT_RUNS))
+
+POLL_INTERVAL = 0.2
+
+# Exit status we report for runs that we stopped, by reason
+EXIT_STATUS = {
+    "timed_out": -signal.SIGALRM,
+    "memory_exceeded": -signal.SIGKILL,
+    "cancelled": -signal.SIGTERM,
+}
+
+
+class RunInterrupted(BaseException):
+    """
+    Raised in the main thread by run_in_process, a BaseException so a plain except Exception does not swallow it
+    """
+    pass
+
+
+def _acquire_slot(timeout):
+    """
+    Takes one of MAX_CONCURRENT_RUNS flock slots, waiting up to timeout seconds for one to free up.
+
+    :return: open slot file, closing it releases the slot. None if we ran out of time
+    """
+    os.makedirs(SLOTS_FOLDER, exist_ok=True)
+
+    start_time = time.time()
+    while True:
+        for slot in range(MAX_CONCURRENT_RUNS):
+            slot_file = open(os.path.join(SLOTS_FOLDER, "slot_{}.lock".format(slot)), "w")
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_file
+            except BlockingIOError:
+                slot_file.close()
+
+        if time.time() - start_time > timeout:
+            return None
+
+        time.sleep(POLL_INTERVAL * 5)
+
+
+def _rss_mb(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+def _new_result():
+    return {
+        "exit_status": None,
+        "duration": 0,
+        "max_rss_mb": 0,
+        "timed_out": False,
+        "memory_exceeded": False,
+        "cancelled": False,
+    }
+
+
+def _check_limits(result, rss_mb, start_time, timeout, max_memory_mb, should_cancel):
+    """
+    :return: the reason to stop the run (a key of EXIT_STATUS) or None to let it go on
+    """
+    result["max_rss_mb"] = max(result["max_rss_mb"], rss_mb)
+
+    if time.time() - start_time > timeout:
+        return "timed_out"
+    if max_memory_mb is not None and rss_mb > max_memory_mb:
+        return "memory_exceeded"
+    if should_cancel is not None and should_cancel():
+        return "cancelled"
+
+    return None
+
+
+def _run_with_slot(run, timeout, description):
+    """
+    :param run: function that runs with the seconds left of the timeout, the wait for a slot counts towards it
+    """
+    deadline = time.time() + timeout
+
+    slot_file = _acquire_slot(timeout)
+    if slot_file is None:
+        result = _new_result()
+        result["timed_out"] = True
+        result["exit_status"] = EXIT_STATUS["timed_out"]
+    else:
+        try:
+            start_time = time.time()
+            result = run(deadline - start_time)
+            result["duration"] = time.time() - start_time
+        finally:
+            slot_file.close()
+
+    print("Finished", description, result, file=sys.stderr, flush=True)
+
+    return result
+
+
+def run_command(arguments, cwd=None, timeout=DEFAULT_TIMEOUT, max_memory_mb=DEFAULT_MAX_MEMORY_MB, should_cancel=None,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, pass_fds=()):
+    """
+    Runs an external program under the limits, without a shell.
+
+    :param arguments: argument list, e.g. ["./bin/search", "query.mgf", "-l", "./bin/library"]
+    :param should_cancel: optional function, the run is killed as soon as it returns True
+    :return: result dict with exit_status, duration, max_rss_mb, timed_out, memory_exceeded, cancelled
+    """
+    def run(timeout):
+        result = _new_result()
+        start_time = time.time()
+
+        # Own process group, so anything it spawned is killed with it
+        process = subprocess.Popen(arguments, cwd=cwd, stdin=stdin, stdout=stdout, pass_fds=pass_fds, start_new_session=True)
+
+        while process.poll() is None:
+            reason = _check_limits(result, _rss_mb(process.pid), start_time, timeout, max_memory_mb, should_cancel)
+            if reason is not None:
+                result[reason] = True
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                process.wait()
+                result["exit_status"] = EXIT_STATUS[reason]
+                return result
+
+            time.sleep(POLL_INTERVAL)
+
+        result["exit_status"] = process.returncode
+        return result
+
+    return _run_with_slot(run, timeout, " ".join(arguments))
+
+
+def run_in_process(function, arguments, timeout=DEFAULT_TIMEOUT, max_memory_mb=DEFAULT_MAX_MEMORY_MB, should_cancel=None):
+    """
+    Calls function(*arguments) in this process under the limits, has to be called from the main thread.
+
+    The memory limit applies to what the run adds on top of the process, not to the already loaded tables.
+    The return value of function is used as exit status, exceptions count as 1.
+
+    :return: same result dict as run_command
+    """
+    def run(timeout):
+        result = _new_result()
+        start_time = time.time()
+        baseline_rss_mb = _rss_mb(os.getpid())
+        main_thread_id = threading.main_thread().ident
+        finished = threading.Event()
+        stop_reason = []
+
+        def watchdog():
+            while not finished.wait(POLL_INTERVAL):
+                if not stop_reason:
+                    rss_mb = _rss_mb(os.getpid()) - baseline_rss_mb
+                    reason = _check_limits(result, rss_mb, start_time, timeout, max_memory_mb, should_cancel)
+                    if reason is None:
+                        continue
+                    stop_reason.append(reason)
+
+                # Keep poking, in case the run swallowed the first interrupt
+                signal.pthread_kill(main_thread_id, signal.SIGUSR2)
+                finished.wait(1)
+
+        def interrupt(signum, frame):
+            if stop_reason and not finished.is_set():
+                raise RunInterrupted(stop_reason[0])
+
+        previous_handler = signal.signal(signal.SIGUSR2, interrupt)
+        watchdog_thread = threading.Thread(target=watchdog, daemon=True)
+        watchdog_thread.start()
+        try:
+            exit_status = function(*arguments)
+            result["exit_status"] = exit_status if isinstance(exit_status, int) else 0
+        except RunInterrupted as e:
+            result[str(e)] = True
+            result["exit_status"] = EXIT_STATUS[str(e)]
+        except Exception as e:
+            print("Failed", function.__name__, repr(e), file=sys.stderr, flush=True)
+            result["exit_status"] = 1
+        finally:
+            finished.set()
+            watchdog_thread.join()
+            signal.signal(signal.SIGUSR2, previous_handler)
+
+        return result
+
+    return _run_with_slot(run, timeout, function.__name__)
+
+
+def _unblock_fifo(path, flags, thread):
+    """
+    Opens the other end of a fifo until the thread waiting on it is done, in case the program exited
+    without ever opening it.
+    """
+    while thread.is_alive():
+        try:
+            fd = os.open(path, flags | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            pass
+        thread.join(POLL_INTERVAL)
+
+
+def run_command_with_pipes(arguments, input_data, input_filename="input", output_filename="output", on_output_line=None,
+                           use_pipes=True, **kwargs):
+    """
+    Runs a program that reads its input from a file and writes its output to a file, without either
+    touching the disk. The paths are named pipes with the given file names, so programs that look at the
+    extension still work. The output is handed over line by line while the program is still running.
+
+    :param arguments: argument list, "{input}" and "{output}" are replaced by the paths
+    :param input_data: text the program reads from {input}
+    :param on_output_line: called with every line the program writes to {output}
+    :param use_pipes: False uses regular files in a temporary folder, for programs that seek in their files
+    :return: same result dict as run_command
+    """
+    with tempfile.TemporaryDirectory(prefix="masst_run_") as run_folder:
+        input_path = os.path.join(run_folder, input_filename)
+        output_path = os.path.join(run_folder, output_filename)
+        arguments = [argument.replace("{input}", input_path).replace("{output}", output_path) for argument in arguments]
+
+        def read_output():
+            with open(output_path) as f:
+                for line in f:
+                    if on_output_line is not None:
+                        on_output_line(line)
+
+        if not use_pipes:
+            with open(input_path, "w") as o:
+                o.write(input_data)
+
+            result = run_command(arguments, **kwargs)
+
+            if os.path.isfile(output_path):
+                read_output()
+
+            return result
+
+        os.mkfifo(input_path)
+        os.mkfifo(output_path)
+
+        def write_input():
+            try:
+                # Blocks until the program opens it
+                with open(input_path, "w") as o:
+                    o.write(input_data)
+            except OSError:
+                # The program stopped reading, e.g. it was killed
+                pass
+
+        writer_thread = threading.Thread(target=write_input, daemon=True)
+        reader_thread = threading.Thread(target=read_output, daemon=True)
+        writer_thread.start()
+        reader_thread.start()
+
+        try:
+            result = run_command(arguments, **kwargs)
+        finally:
+            _unblock_fifo(input_path, os.O_RDONLY, writer_thread)
+            _unblock_fifo(output_path, os.O_WRONLY, reader_thread)
+
+        return result
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Cosine and shifted (analog) cosine of one query against many library spectra, vectorized with numpy.
+
+./bin/search and fasst only return the score, so hits can not be scored again with other settings without
+another search. Here the candidates are stored CSR style, all their peaks in one array:
+
+    mz, intensity   peaks of all candidates, each candidate sorted by m/z
+    indptr          peaks of candidate c are mz[indptr[c]:indptr[c + 1]]
+
+to_csr and from_padded build that from lists of peaks or from padded (candidates, peaks) arrays.
+
+The peaks are matched greedily, the largest intensity products first and every peak at most once, like the
+GNPS cosine. The greedy assignment is done in rounds over all candidates at once: every pair that is the
+best left for both its query and its library peak is taken, the pairs that conflict with it are dropped.
+"""
+import numpy as np
+
+FRAGMENT_TOLERANCE = 0.02
+
+# Intensities are scaled with this power before the vectors are normalized, 0.5 is the square root
+INTENSITY_POWER = 0.5
+
+
+def to_csr(peaks_list):
+    """
+    :param peaks_list: list of (n, 2) arrays or lists of [m/z, intensity]
+    :return: mz, intensity, indptr
+    """
+    peak_arrays = [np.asarray(peaks, dtype=np.float64).reshape(-1, 2) for peaks in peaks_list]
+    peak_arrays = [peaks[np.argsort(peaks[:, 0], kind="stable")] for peaks in peak_arrays]
+
+    indptr = np.zeros(len(peak_arrays) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(peaks) for peaks in peak_arrays])
+
+    if len(peak_arrays) == 0 or indptr[-1] == 0:
+        return np.zeros(0), np.zeros(0), indptr
+
+    all_peaks = np.concatenate(peak_arrays)
+
+    return all_peaks[:, 0], all_peaks[:, 1], indptr
+
+
+def from_padded(mz, intensity):
+    """
+    :param mz: (candidates, max peaks) array, padding is NaN or an intensity of 0
+    :return: mz, intensity, indptr
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    valid = ~np.isnan(mz) & (intensity > 0)
+
+    return to_csr([np.column_stack([mz[c][valid[c]], intensity[c][valid[c]]]) for c in range(len(mz))])
+
+
+def _normalize(intensity, indptr, intensity_power):
+    """
+    :return: intensities scaled and normalized to unit length per spectrum
+    """
+    scaled = np.power(intensity, intensity_power)
+    spectrum_index = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+    norms = np.sqrt(np.bincount(spectrum_index, weights=scaled * scaled, minlength=len(indptr) - 1))
+    norms[norms == 0] = 1
+
+    return scaled / norms[spectrum_index]
+
+
+def _pairs(query_mz, library_mz, shifts, tolerance):
+    """
+    :param shifts: m/z added to each library peak before it is compared
+    :return: (query peak, library peak) index arrays of the peaks within the tolerance
+    """
+    shifted_mz = library_mz + shifts
+    starts = np.searchsorted(query_mz, shifted_mz - tolerance, side="left")
+    ends = np.searchsorted(query_mz, shifted_mz + tolerance, side="right")
+    counts = ends - starts
+
+    library_peaks = np.repeat(np.arange(len(library_mz)), counts)
+    # Position of every pair within its library peak's run of query peaks
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    query_peaks = np.repeat(starts, counts) + offsets
+
+    return query_peaks, library_peaks
+
+
+def _greedy_assignment(products, query_keys, library_keys):
+    """
+    :return: boolean array of the pairs that a greedy assignment by descending product takes
+    """
+    # Greedy order, ties in the order of the pairs
+    order = np.lexsort((np.arange(len(products)), -products))
+    remaining = order
+    taken = np.zeros(len(products), dtype=bool)
+
+    while len(remaining) > 0:
+        # First pair in greedy order of every query and every library peak
+        _, first_query = np.unique(query_keys[remaining], return_index=True)
+        _, first_library = np.unique(library_keys[remaining], return_index=True)
+
+        best_query = np.zeros(len(remaining), dtype=bool)
+        best_query[first_query] = True
+        best_library = np.zeros(len(remaining), dtype=bool)
+        best_library[first_library] = True
+
+        accepted = remaining[best_query & best_library]
+        taken[accepted] = True
+
+        used = ~np.isin(query_keys[remaining], query_keys[accepted]) & ~np.isin(library_keys[remaining], library_keys[accepted])
+        remaining = remaining[used]
+
+    return taken
+
+
+def score(query_peaks, query_precursor_mz, mz, intensity, indptr, precursor_mzs=None, shifted=False,
+          tolerance=FRAGMENT_TOLERANCE, intensity_power=INTENSITY_POWER):
+    """
+    Scores one query against all candidates.
+
+    :param query_peaks: (n, 2) array of m/z and intensity
+    :param mz, intensity, indptr: candidates, see to_csr
+    :param precursor_mzs: precursor m/z per candidate, needed for shifted
+    :param shifted: shifted cosine, library peaks also match when shifted by the precursor difference
+    :return: dict with score and matched_peaks per candidate, and the matches as arrays candidate,
+             query_peak and library_peak (indices into the peaks sorted by m/z, library_peak per candidate)
+    """
+    query_peaks = np.asarray(query_peaks, dtype=np.float64).reshape(-1, 2)
+    query_peaks = query_peaks[np.argsort(query_peaks[:, 0], kind="stable")]
+    query_mz = query_peaks[:, 0]
+    query_intensity = _normalize(query_peaks[:, 1], np.array([0, len(query_peaks)]), intensity_power)
+
+    candidate_count = len(indptr) - 1
+    library_intensity = _normalize(np.asarray(intensity, dtype=np.float64), indptr, intensity_power)
+    library_candidate = np.repeat(np.arange(candidate_count), np.diff(indptr))
+
+    query_pairs, library_pairs = _pairs(query_mz, mz, np.zeros(len(mz)), tolerance)
+
+    if shifted:
+        if precursor_mzs is None:
+            raise ValueError("Shifted cosine needs the precursor m/z of the candidates")
+
+        shifts = (query_precursor_mz - np.asarray(precursor_mzs, dtype=np.float64))[library_candidate]
+        shifted_query_pairs, shifted_library_pairs = _pairs(query_mz, mz, shifts, tolerance)
+
+        # A pair found both ways counts once
+        pair_keys = np.unique(np.concatenate([library_pairs * len(query_mz) + query_pairs,
+                                              shifted_library_pairs * len(query_mz) + shifted_query_pairs]))
+        library_pairs = pair_keys // max(len(query_mz), 1)
+        query_pairs = pair_keys % max(len(query_mz), 1)
+
+    pair_candidates = library_candidate[library_pairs]
+    products = query_intensity[query_pairs] * library_intensity[library_pairs]
+
+    # Query peaks are used once per candidate, library peaks are unique over all candidates already
+    taken = _greedy_assignment(products, pair_candidates * len(query_mz) + query_pairs, library_pairs)
+
+    matched_candidates = pair_candidates[taken]
+
+    return {
+        "score": np.bincount(matched_candidates, weights=products[taken], minlength=candidate_count),
+        "matched_peaks": np.bincount(matched_candidates, minlength=candidate_count),
+        "candidate": matched_candidates,
+        "query_peak": query_pairs[taken],
+        "library_peak": library_pairs[taken] - indptr[matched_candidates],
+    }
+
+
+def score_spectra(query, candidates, shifted=False, tolerance=FRAGMENT_TOLERANCE, intensity_power=INTENSITY_POWER):
+    """
+    :param query: dict with precursor_mz and peaks
+    :param candidates: list of dicts with precursor_mz and peaks, e.g. from masst_catalog.read_spectrum
+    :return: see score
+    """
+    mz, intensity, indptr = to_csr([candidate["peaks"] for candidate in candidates])
+    precursor_mzs = np.array([candidate["precursor_mz"] for candidate in candidates], dtype=np.float64)
+
+    return score(query["peaks"], query["precursor_mz"], mz, intensity, indptr, precursor_mzs=precursor_mzs,
+                 shifted=shifted, tolerance=tolerance, intensity_power=intensity_power)
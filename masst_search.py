@@ -0,0 +1,1171 @@
+# -*- coding: utf-8 -*-
+"""
+Shared search plumbing for the domain MASST dashboards (microbeMASST, foodMASST, plantMASST, ...).
+
+The dashboards only collect the search parameters and submit them here. The actual fastMASST
+run happens on the celery worker (tasks.task_domainmasst) and the page polls search_status
+until the results html is ready in temp/microbemasst/<task>.
+
+A single fastMASST run renders the trees for every domain, so the task id is a deterministic key of
+the query (spectrum plus parameters). Dashboards searching the same spectrum with the same parameters
+render from the same temp/microbemasst/<key> folder instead of searching again. The database is one of
+the parameters, so this only happens within a database group: microbeMASST, microbiomeMASST,
+personalcareMASST and tissueMASST pass metabolomicspanrepo_index_nightly and share with each other,
+plantMASST, foodMASST and metadataMASST use the microbe_masst default database and share among themselves.
+
+Finished searches are kept in a result cache until the next metabolomicspanrepo_index_nightly
+refresh, the index build is part of the key so results never outlive the index they came from.
+
+Identical searches submitted while one is already running attach to it instead of queueing another
+fastMASST run. The in flight claim is a lock file in the output folder, so it works across the
+gunicorn workers and the celery worker.
+
+The worker runs the microbe_masst scripts in process instead of spawning a new python for every
+search, so the imports and the static metadata tables are loaded once per worker. masst_runner
+applies the time, memory and concurrency limits, and cancels searches that every page watching
+them has left or replaced with a new search.
+
+Several spectra, pasted as MGF or uploaded as MGF/mzML/mzXML, are searched as one batch on their own
+queue (BATCH_QUEUE). batch_results and batch_matches combine the per spectrum results of a batch.
+
+partial_matches lets the dashboards show the fastMASST matches while the trees are still rendering.
+"""
+import base64
+import contextlib
+import datetime
+import functools
+import hashlib
+import io
+import json
+import os
+import runpy
+import sys
+import time
+
+from flask_caching import Cache
+
+from app import app
+import masst_http
+import masst_runner
+
+# keep temp/microbemasst as the folder for the results, every domain html is generated there
+OUTPUT_ROOT = os.path.join("temp", "microbemasst")
+# The search itself runs inside microbe_masst/code, the watchdog checks the state files from there
+OUTPUT_ROOT_PATH = os.path.abspath(OUTPUT_ROOT)
+MICROBE_MASST_CODE = os.path.join("microbe_masst", "code")
+
+# Written by the worker once the microbe_masst script has returned, holds the exit status as json
+DONE_FILENAME = "search_done.json"
+
+# Created with O_EXCL by whoever queues a search first, removed by the worker when it is done
+INFLIGHT_FILENAME = "search_inflight.json"
+
+# Celery time limit of a search, a claim older than this is from a killed worker
+SEARCH_TIME_LIMIT = 900
+
+# Multi-spectrum searches (pasted or uploaded MGF) run on their own queue, so a long batch does not hold up
+# the single spectrum searches. The batch worker sets how many spectra microbe_masst searches in parallel.
+BATCH_QUEUE = "searchbatchworker"
+BATCH_TIME_LIMIT = 4 * 3600
+BATCH_PARALLEL_QUERIES = int(os.environ.get("MASST_BATCH_PARALLEL_QUERIES", 10))
+MAX_BATCH_SPECTRA = int(os.environ.get("MASST_MAX_BATCH_SPECTRA", 500))
+
+# Every page polling a search touches its own file in here
+WATCHERS_FOLDERNAME = "watchers"
+# Created when the last page watching a search moved on, the worker then stops it
+CANCEL_FILENAME = "search_cancel"
+
+# The dashboards poll every 2 seconds, a search nobody polled for this long was abandoned
+ABANDONED_TIMEOUT = 60
+
+# fastMASST rebuilds metabolomicspanrepo_index_nightly once a day, cached results expire with it
+INDEX_REFRESH_HOUR_UTC = int(os.environ.get("MASST_INDEX_REFRESH_HOUR_UTC", 0))
+
+# Celery states after which polling can stop and the results page is shown
+FINISHED_STATES = ["SUCCESS", "FAILURE", "REVOKED"]
+
+# Matches shown while the trees of a search are still rendering, the full table is in the results
+PARTIAL_MATCHES_MAX_ROWS = 5000
+
+STATUS_MESSAGES = {
+    "PENDING": "Search queued, waiting for a free worker...",
+    "STARTED": "Search running, this page updates automatically when the results are ready...",
+    "RETRY": "Search is being retried...",
+}
+
+# Finished searches by key, the html itself stays in temp/microbemasst/<key>
+result_cache = Cache(app, config={
+    'CACHE_TYPE': 'filesystem',
+    'CACHE_DIR': 'temp/flask-cache/masst-results',
+    'CACHE_DEFAULT_TIMEOUT': 0,
+    'CACHE_THRESHOLD': 20000
+})
+
+# Uploaded batches as canonical MGF by upload id, so a search only sends the id and not the file again
+upload_cache = Cache(app, config={
+    'CACHE_TYPE': 'filesystem',
+    'CACHE_DIR': 'temp/flask-cache/masst-uploads',
+    'CACHE_DEFAULT_TIMEOUT': 24 * 3600,
+    'CACHE_THRESHOLD': 1000
+})
+
+CACHE_HITS_KEY = "masst_result_cache_hits"
+CACHE_MISSES_KEY = "masst_result_cache_misses"
+
+
+def output_folder(task):
+    # basename so a task id can never point outside of temp/microbemasst
+    return os.path.join(OUTPUT_ROOT, os.path.basename(task))
+
+
+def _state_folder(task):
+    # same folder as output_folder, but independent of the working directory
+    return os.path.join(OUTPUT_ROOT_PATH, os.path.basename(task))
+
+
+def _last_index_refresh(now=None):
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    last_refresh = now.replace(hour=INDEX_REFRESH_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if last_refresh > now:
+        last_refresh -= datetime.timedelta(days=1)
+
+    return last_refresh
+
+
+def index_version(now=None):
+    """
+    Identifies the nightly index build that a search right now runs against, e.g. 2024061500
+    """
+    return _last_index_refresh(now).strftime("%Y%m%d%H")
+
+
+def seconds_until_index_refresh(now=None):
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    next_refresh = _last_index_refresh(now) + datetime.timedelta(days=1)
+
+    return max(int((next_refresh - now).total_seconds()), 1)
+
+
+def _canonical_peaks(peaks):
+    peak_list = []
+    for line in peaks.strip().split("\n"):
+        values = line.replace(",", " ").replace("\t", " ").split()
+        if len(values) >= 2:
+            peak_list.append((float(values[0]), float(values[1])))
+
+    return sorted(peak_list)
+
+
+def search_key(search_parameters):
+    """
+    Deterministic key for a search, the same spectrum and parameters always give the same key
+    no matter which dashboard submitted it or how the numbers were typed in. The database is part of
+    the key as passed, a missing one (the microbe_masst default) is a key of its own. The nightly index
+    build is part of the key, so a search after the refresh runs again.
+
+    :param search_parameters: same dict as build_search_arguments
+    :return: hex digest used as task id and output folder name
+    """
+    canonical = {}
+    for key, value in search_parameters.items():
+        if value is None or value == "":
+            continue
+
+        if key == "peaks":
+            # The peaks can be long, so they go into the key as their own hash
+            try:
+                value = json.dumps(_canonical_peaks(value))
+            except ValueError:
+                pass
+            value = hashlib.sha256(value.encode()).hexdigest()
+        elif key == "mgf":
+            # Already canonical, see batch_mgf
+            value = hashlib.sha256(value.encode()).hexdigest()
+        elif key in ["usi", "database"]:
+            value = str(value).strip()
+        elif not isinstance(value, bool):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = str(value)
+
+        canonical[key] = value
+
+    canonical["index_version"] = index_version()
+
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def status_message(status):
+    return STATUS_MESSAGES.get(status, "Search status: {}".format(status))
+
+
+def sort_and_filter_by_intensity(peaks_string, max_peaks=None):
+    if max_peaks is not None:
+        lines = peaks_string.strip().split('\n')
+        pairs = [tuple(map(float, line.split())) for line in lines if line.strip()]
+
+        # Create a dictionary to store the most intense peak for each rounded m/z
+        peak_dict = {}
+        for mz, intensity in pairs:
+            mz_rounded = round(mz)
+            if mz_rounded not in peak_dict or intensity > peak_dict[mz_rounded][1]:
+                peak_dict[mz_rounded] = (mz, intensity)
+
+        # Get the list of most intense peaks per rounded m/z and sort by intensity
+        unique_peaks = list(peak_dict.values())
+        sorted_peaks = sorted(unique_peaks, key=lambda x: x[1], reverse=True)[:max_peaks]
+
+        # Sort the final result by m/z
+        sorted_by_mz = sorted(sorted_peaks, key=lambda x: x[0])
+        filtered_peaks = '\n'.join(f"{mz} {intensity}" for mz, intensity in sorted_by_mz)
+    else:
+        filtered_peaks = peaks_string
+
+    return filtered_peaks
+
+
+def _write_query_mgf(output_temp, precursor_mz, charge, peaks):
+    mgf_string = """BEGIN IONS
+PEPMASS={}
+MSLEVEL=2
+CHARGE={}
+{}
+END IONS\n""".format(precursor_mz, charge, peaks)
+
+    mgf_filename = os.path.join(output_temp, "input_spectra.mgf")
+    with open(mgf_filename, "w") as o:
+        o.write(mgf_string)
+
+    return mgf_filename
+
+
+def is_batch(search_parameters):
+    return bool(search_parameters.get("mgf"))
+
+
+def search_time_limit(search_parameters):
+    return BATCH_TIME_LIMIT if is_batch(search_parameters) else SEARCH_TIME_LIMIT
+
+
+def looks_like_mgf(text):
+    return text is not None and "BEGIN IONS" in text.upper()
+
+
+def parse_mgf(mgf_text):
+    """
+    Minimal MGF reader for pasted or uploaded query spectra.
+
+    :return: list of spectra, dicts with title, precursor_mz, charge and peaks as (m/z, intensity) tuples
+    """
+    spectra = []
+    spectrum = None
+
+    for line in mgf_text.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line[0] in "#;!/":
+            continue
+
+        if line.upper() == "BEGIN IONS":
+            spectrum = {"title": None, "precursor_mz": None, "charge": 1, "peaks": []}
+        elif line.upper() == "END IONS":
+            if spectrum is not None:
+                spectra.append(spectrum)
+            spectrum = None
+        elif spectrum is None:
+            continue
+        elif "=" in line:
+            key, value = line.split("=", 1)
+            key = key.strip().upper()
+            value = value.strip()
+
+            if key == "PEPMASS":
+                spectrum["precursor_mz"] = float(value.split()[0])
+            elif key == "CHARGE":
+                # e.g. 2+ or 2+ and 3+
+                charge = value.split()[0].strip("+-")
+                spectrum["charge"] = int(charge) if charge.isdigit() else 1
+            elif key == "TITLE":
+                spectrum["title"] = value
+        else:
+            values = line.replace(",", " ").replace("\t", " ").split()
+            if len(values) >= 2:
+                spectrum["peaks"].append((float(values[0]), float(values[1])))
+
+    return spectra
+
+
+def read_uploaded_spectra(filename, contents):
+    """
+    Reads the MS2 spectra of a file uploaded on a dashboard.
+
+    :param filename: uploaded file name, the extension has to be one of views.ALLOWED_EXTENSIONS
+    :param contents: dcc.Upload contents, a base64 data url
+    :return: same list of spectra as parse_mgf
+    """
+    from views import ALLOWED_EXTENSIONS
+
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if extension not in ALLOWED_EXTENSIONS:
+        raise ValueError("Unsupported file type, use one of {}".format(", ".join(sorted(ALLOWED_EXTENSIONS))))
+
+    data = base64.b64decode(contents.split(",", 1)[-1])
+
+    if extension == "mgf":
+        return parse_mgf(data.decode("utf-8", errors="replace"))
+
+    from pyteomics import mzml, mzxml
+
+    spectra = []
+    if extension == "mzml":
+        with mzml.MzML(io.BytesIO(data)) as reader:
+            for spectrum in reader:
+                if spectrum.get("ms level") != 2:
+                    continue
+
+                selected_ion = spectrum["precursorList"]["precursor"][0]["selectedIonList"]["selectedIon"][0]
+                spectra.append({
+                    "title": spectrum.get("id"),
+                    "precursor_mz": float(selected_ion["selected ion m/z"]),
+                    "charge": int(selected_ion.get("charge state", 1)),
+                    "peaks": list(zip(spectrum["m/z array"], spectrum["intensity array"])),
+                })
+
+                # Too many for a batch anyway, batch_mgf rejects it
+                if len(spectra) > MAX_BATCH_SPECTRA:
+                    break
+    else:
+        with mzxml.MzXML(io.BytesIO(data)) as reader:
+            for spectrum in reader:
+                if spectrum.get("msLevel") != 2:
+                    continue
+
+                precursor = spectrum["precursorMz"][0]
+                spectra.append({
+                    "title": "scan {}".format(spectrum.get("num")),
+                    "precursor_mz": float(precursor["precursorMz"]),
+                    "charge": int(precursor.get("precursorCharge", 1)),
+                    "peaks": list(zip(spectrum["m/z array"], spectrum["intensity array"])),
+                })
+
+                if len(spectra) > MAX_BATCH_SPECTRA:
+                    break
+
+    return spectra
+
+
+def batch_mgf(spectra):
+    """
+    Checks the query spectra of a batch and writes them as one MGF. The text is canonical, so it is
+    both the input of the batch search and part of its key.
+
+    :return: MGF text, raises ValueError with a message for the page if the spectra can not be searched
+    """
+    spectra = [spectrum for spectrum in spectra if spectrum["precursor_mz"] and len(spectrum["peaks"]) > 0]
+
+    if len(spectra) == 0:
+        raise ValueError("No spectra with a precursor m/z and peaks found")
+    if len(spectra) > MAX_BATCH_SPECTRA:
+        raise ValueError("Too many spectra, a batch can have at most {}".format(MAX_BATCH_SPECTRA))
+
+    mgf_blocks = []
+    for scan, spectrum in enumerate(spectra, start=1):
+        title = (spectrum["title"] or "scan {}".format(scan)).replace("\n", " ")
+        peaks = "\n".join("{} {}".format(mz, intensity) for mz, intensity in sorted(spectrum["peaks"]))
+
+        mgf_blocks.append("BEGIN IONS\nTITLE={}\nSCANS={}\nPEPMASS={}\nMSLEVEL=2\nCHARGE={}\n{}\nEND IONS\n".format(
+            title, scan, spectrum["precursor_mz"], spectrum["charge"], peaks))
+
+    return "\n".join(mgf_blocks)
+
+
+def save_upload(filename, contents):
+    """
+    Reads a file uploaded on a dashboard into the canonical MGF of a batch and keeps it on the server.
+
+    :return: upload id for load_upload and the number of spectra, raises if the file can not be read
+    """
+    spectra = read_uploaded_spectra(filename, contents)
+    mgf = batch_mgf(spectra)
+
+    upload_id = hashlib.sha256(mgf.encode()).hexdigest()
+    upload_cache.set(upload_id, mgf)
+
+    return upload_id, len(spectra)
+
+
+def load_upload(upload_id):
+    """
+    :return: canonical MGF of the upload, None if it expired
+    """
+    return upload_cache.get(upload_id)
+
+
+def build_search_arguments(output_temp, search_parameters):
+    """
+    Builds the microbe_masst arguments for a search, the same flags the dashboards used on the command line.
+
+    :param output_temp: folder for the results, temp/microbemasst/<task>
+    :param search_parameters: dict with either usi or peaks/precursor_mz/charge, max_peaks and the search tolerances
+    :return: script in microbe_masst/code and its argument list, paths are relative to microbe_masst/code
+    """
+    out_file = "../../{}/fastMASST".format(output_temp)
+
+    usi = search_parameters.get("usi")
+    max_peaks = search_parameters.get("max_peaks")
+
+    if is_batch(search_parameters):
+        mgf_filename = os.path.join(output_temp, "input_spectra.mgf")
+        with open(mgf_filename, "w") as o:
+            o.write(search_parameters["mgf"])
+
+        # One results set per query spectrum, see batch_results
+        script = "masst_batch_client.py"
+        arguments = [
+            "--in_file", os.path.join("../..", mgf_filename),
+            "--out_file", out_file,
+            "--parallel_queries", str(BATCH_PARALLEL_QUERIES),
+            "--precursor_mz_tol", str(search_parameters["precursor_mz_tol"]),
+            "--mz_tol", str(search_parameters["mz_tol"]),
+            "--min_cos", str(search_parameters["min_cos"]),
+            "--min_matched_signals", str(search_parameters["min_matched_signals"]),
+            "--analog", str(search_parameters["analog"]),
+            "--analog_mass_below", str(search_parameters["analog_mass_below"]),
+            "--analog_mass_above", str(search_parameters["analog_mass_above"]),
+        ]
+    elif usi and max_peaks is None:
+        script = "masst_client.py"
+        arguments = [
+            "--usi_or_lib_id", usi,
+            "--out_file", out_file,
+            "--precursor_mz_tol", str(search_parameters["precursor_mz_tol"]),
+            "--mz_tol", str(search_parameters["mz_tol"]),
+            "--min_cos", str(search_parameters["min_cos"]),
+            "--min_matched_signals", str(search_parameters["min_matched_signals"]),
+            "--analog_mass_below", str(search_parameters["analog_mass_below"]),
+            "--analog_mass_above", str(search_parameters["analog_mass_above"]),
+        ]
+
+        # Tacking on the analog flag
+        if search_parameters["analog"]:
+            arguments += ["--analog", "true"]
+    else:
+        if usi:
+            # Retrieve peaks using the API so we can keep only the top N peaks
+            url = f"https://metabolomics-usi.gnps2.org/json/?usi1={usi}"
+            data = masst_http.get(url).json()
+
+            spectrum_details = data.get("peaks", [])
+            peaks_list = "\n".join(f"{mz} {intensity}" for mz, intensity in spectrum_details)
+            peaks = sort_and_filter_by_intensity(peaks_list, max_peaks)
+            precursor_mz = data.get("precursor_mz")
+            charge = data.get("precursor_charge", 1)
+        else:
+            peaks = search_parameters["peaks"]
+            precursor_mz = search_parameters["precursor_mz"]
+            charge = search_parameters.get("charge", 1)
+
+        mgf_filename = _write_query_mgf(output_temp, precursor_mz, charge, peaks)
+
+        script = "masst_batch_client.py"
+        arguments = [
+            "--in_file", os.path.join("../..", mgf_filename),
+            "--out_file", out_file,
+            "--parallel_queries", "1",
+            "--precursor_mz_tol", str(search_parameters["precursor_mz_tol"]),
+            "--mz_tol", str(search_parameters["mz_tol"]),
+            "--min_cos", str(search_parameters["min_cos"]),
+            "--min_matched_signals", str(search_parameters["min_matched_signals"]),
+            "--analog", str(search_parameters["analog"]),
+            "--analog_mass_below", str(search_parameters["analog_mass_below"]),
+            "--analog_mass_above", str(search_parameters["analog_mass_above"]),
+        ]
+
+    if search_parameters.get("database"):
+        arguments += ["--database", search_parameters["database"]]
+
+    return script, arguments
+
+
+# Static tables of microbe_masst (metadata, ontologies, trees), read once per worker process by warm_up
+STATIC_TABLES_FOLDER = os.path.join("microbe_masst", "data")
+STATIC_TABLE_EXTENSIONS = (".csv", ".tsv", ".feather", ".parquet")
+
+# realpath -> (mtime, {(reader, arguments): table}), only the files found by warm_up are ever keys
+_static_tables = {}
+_warmed_up = False
+
+
+def _static_table_paths():
+    paths = []
+    for folder, _, filenames in os.walk(STATIC_TABLES_FOLDER):
+        paths += [os.path.realpath(os.path.join(folder, filename)) for filename in filenames
+                  if filename.lower().endswith(STATIC_TABLE_EXTENSIONS)]
+
+    return paths
+
+
+def _cached_static_reader(reader):
+    """
+    Wraps a pandas reader so the static tables found by warm_up are parsed once per worker process.
+    Every other path, and chunked or iterator reads, go to the reader unchanged. Every caller gets its own
+    copy, so the searches cannot modify each other.
+    """
+    @functools.wraps(reader)
+    def read(path, *args, **kwargs):
+        if not isinstance(path, (str, os.PathLike)) or "chunksize" in kwargs or kwargs.get("iterator"):
+            return reader(path, *args, **kwargs)
+
+        full_path = os.path.realpath(path)
+        if full_path not in _static_tables or not os.path.isfile(full_path):
+            return reader(path, *args, **kwargs)
+
+        # An updated submodule replaces the tables of the file instead of adding to them
+        mtime = os.path.getmtime(full_path)
+        if _static_tables[full_path][0] != mtime:
+            _static_tables[full_path] = (mtime, {})
+
+        tables = _static_tables[full_path][1]
+        key = (reader.__name__, repr(args), repr(sorted(kwargs.items())))
+        if key not in tables:
+            tables[key] = reader(path, *args, **kwargs)
+
+        return tables[key].copy()
+
+    return read
+
+
+@contextlib.contextmanager
+def _static_readers():
+    """
+    Wraps the pandas readers only while microbe_masst runs, the rest of the process keeps the plain ones.
+    """
+    import pandas as pd
+
+    readers = {name: getattr(pd, name) for name in ["read_csv", "read_feather", "read_parquet"]}
+    for name, reader in readers.items():
+        setattr(pd, name, _cached_static_reader(reader))
+    try:
+        yield
+    finally:
+        for name, reader in readers.items():
+            setattr(pd, name, reader)
+
+
+def warm_up():
+    """
+    Prepares the current process to run microbe_masst in process: imports the microbe_masst code
+    with its pandas and tree dependencies and finds its static tables, which are cached from here on.
+
+    Called once in the search worker before the pool forks, so every worker child starts warm.
+    """
+    global _warmed_up
+
+    if _warmed_up:
+        return
+
+    for path in _static_table_paths():
+        _static_tables.setdefault(path, (None, {}))
+
+    code_folder = os.path.realpath(MICROBE_MASST_CODE)
+    if code_folder not in sys.path:
+        sys.path.insert(0, code_folder)
+
+    previous_cwd = os.getcwd()
+    os.chdir(code_folder)
+    try:
+        with _static_readers():
+            import masst_client
+            import masst_batch_client
+    finally:
+        os.chdir(previous_cwd)
+
+    _warmed_up = True
+
+
+def _run_in_process(script, arguments):
+    """
+    Runs a microbe_masst script as __main__ in this process, exactly like the command line would.
+
+    :return: exit status of the script
+    """
+    warm_up()
+
+    code_folder = os.path.realpath(MICROBE_MASST_CODE)
+    previous_cwd = os.getcwd()
+    previous_argv = sys.argv
+
+    # the worker children run one task at a time, so changing the process cwd and argv is safe here
+    os.chdir(code_folder)
+    sys.argv = [script] + arguments
+    try:
+        with _static_readers():
+            runpy.run_path(script, run_name="__main__")
+        exit_status = 0
+    except SystemExit as e:
+        exit_status = e.code if isinstance(e.code, int) else 1
+    finally:
+        os.chdir(previous_cwd)
+        sys.argv = previous_argv
+
+    return exit_status
+
+
+def cache_result(task):
+    result_cache.set(task, {"task": task, "exit_status": 0}, timeout=seconds_until_index_refresh())
+
+
+def _count(key):
+    # Not atomic across the gunicorn workers, good enough for a hit rate
+    result_cache.set(key, (result_cache.get(key) or 0) + 1)
+
+
+def cache_stats():
+    hits = result_cache.get(CACHE_HITS_KEY) or 0
+    misses = result_cache.get(CACHE_MISSES_KEY) or 0
+
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0,
+    }
+
+
+def _read_search_done(task):
+    try:
+        with open(os.path.join(_state_folder(task), DONE_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def claim_time_limit(inflight_filename):
+    """
+    :return: seconds after which the claim in inflight_filename is from a killed worker
+    """
+    try:
+        with open(inflight_filename) as f:
+            return json.load(f).get("time_limit", SEARCH_TIME_LIMIT)
+    except (OSError, ValueError):
+        return SEARCH_TIME_LIMIT
+
+
+def _claim_search(task, time_limit=SEARCH_TIME_LIMIT):
+    """
+    Claims a search so concurrent identical submissions attach to the first one.
+
+    :param time_limit: celery time limit of the search
+    :return: True if we should queue the search, False if it is already in flight
+    """
+    inflight_filename = os.path.join(_state_folder(task), INFLIGHT_FILENAME)
+
+    for attempt in range(2):
+        try:
+            fd = os.open(inflight_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # The worker holding it died or it finished in the meantime, try again
+            if _expire_stale_claim(task) or not os.path.isfile(inflight_filename):
+                continue
+
+            return False
+
+        with os.fdopen(fd, "w") as o:
+            json.dump({"task": task, "claimed": time.time(), "pid": os.getpid(), "time_limit": time_limit}, o)
+
+        return True
+
+    return False
+
+
+def _expire_stale_claim(task):
+    """
+    Removes the claim of a search whose worker was killed without releasing it.
+
+    :return: True if the claim was stale and removed
+    """
+    inflight_filename = os.path.join(_state_folder(task), INFLIGHT_FILENAME)
+
+    try:
+        claim_age = time.time() - os.path.getmtime(inflight_filename)
+    except FileNotFoundError:
+        return False
+
+    if claim_age < claim_time_limit(inflight_filename):
+        return False
+
+    _release_search(task)
+
+    return True
+
+
+def _release_search(task):
+    try:
+        os.remove(os.path.join(_state_folder(task), INFLIGHT_FILENAME))
+    except FileNotFoundError:
+        pass
+
+
+def _watch_search(task, watcher):
+    if watcher is None:
+        return
+
+    watchers_folder = os.path.join(_state_folder(task), WATCHERS_FOLDERNAME)
+    os.makedirs(watchers_folder, exist_ok=True)
+
+    with open(os.path.join(watchers_folder, os.path.basename(watcher)), "w"):
+        pass
+
+
+def _active_watchers(task):
+    """
+    :return: number of pages that polled the search recently, None if it was not submitted from a page
+    """
+    watchers_folder = os.path.join(_state_folder(task), WATCHERS_FOLDERNAME)
+    if not os.path.isdir(watchers_folder):
+        return None
+
+    active_watchers = 0
+    for watcher in os.listdir(watchers_folder):
+        try:
+            if time.time() - os.path.getmtime(os.path.join(watchers_folder, watcher)) < ABANDONED_TIMEOUT:
+                active_watchers += 1
+        except FileNotFoundError:
+            pass
+
+    return active_watchers
+
+
+def _search_abandoned(task):
+    if os.path.isfile(os.path.join(_state_folder(task), CANCEL_FILENAME)):
+        return True
+
+    # Searches from the API have no watchers, they are never abandoned
+    return _active_watchers(task) == 0
+
+
+def cancel_search(task, watcher):
+    """
+    The page watching this search moved on, e.g. it searched something else. The search is stopped
+    unless another page is still waiting for it.
+    """
+    try:
+        os.remove(os.path.join(_state_folder(task), WATCHERS_FOLDERNAME, os.path.basename(watcher)))
+    except FileNotFoundError:
+        pass
+
+    if not os.path.isfile(os.path.join(_state_folder(task), INFLIGHT_FILENAME)):
+        return
+
+    if _active_watchers(task) == 0:
+        with open(os.path.join(_state_folder(task), CANCEL_FILENAME), "w") as o:
+            o.write(watcher)
+
+
+def run_search(task, search_parameters):
+    """
+    Runs the fastMASST search for a task, this is called on the celery worker.
+
+    :return: result dict of masst_runner with the exit status and duration
+    """
+    try:
+        return _run_search(task, search_parameters)
+    finally:
+        _release_search(task)
+
+
+def _run_search(task, search_parameters):
+    output_temp = output_folder(task)
+    os.makedirs(output_temp, exist_ok=True)
+
+    # Another dashboard might have finished the same search while this one was queued
+    search_done = _read_search_done(task)
+    if search_done is not None and search_done["exit_status"] == 0:
+        return search_done
+
+    if _search_abandoned(task):
+        result = {"exit_status": masst_runner.EXIT_STATUS["cancelled"], "cancelled": True, "duration": 0}
+    else:
+        script, arguments = build_search_arguments(output_temp, search_parameters)
+
+        print(script, " ".join(arguments), file=sys.stderr, flush=True)
+        result = masst_runner.run_in_process(_run_in_process, (script, arguments),
+                                             timeout=search_time_limit(search_parameters) - 60,
+                                             should_cancel=lambda: _search_abandoned(task))
+
+    result["task"] = task
+
+    with open(os.path.join(output_temp, DONE_FILENAME), "w") as o:
+        json.dump(result, o)
+
+    try:
+        os.remove(os.path.join(output_temp, CANCEL_FILENAME))
+    except FileNotFoundError:
+        pass
+
+    if result["exit_status"] == 0:
+        cache_result(task)
+
+    return result
+
+
+def submit_search(search_parameters, watcher=None):
+    """
+    Queues a search on the celery worker and returns right away. If the same search already
+    finished, e.g. from another dashboard, nothing is queued and the existing results are used.
+    If it is in flight right now, we attach to the running one.
+
+    :param watcher: id of the page that will poll the search, so we know when nobody is waiting for it anymore
+    :return: task id, used for temp/microbemasst/<task> and the results urls
+    """
+    import tasks
+
+    task = search_key(search_parameters)
+
+    if result_cache.get(task) is not None and os.path.isdir(output_folder(task)):
+        _count(CACHE_HITS_KEY)
+
+        # Last used time for the janitor
+        try:
+            os.utime(output_folder(task))
+        except OSError:
+            pass
+
+        return task
+
+    _count(CACHE_MISSES_KEY)
+
+    search_done = _read_search_done(task)
+    if search_done is not None:
+        if search_done["exit_status"] == 0:
+            # Still on disk from this index build, only the cache entry was evicted
+            cache_result(task)
+            return task
+
+        # Failed before, so we give it another go
+        try:
+            os.remove(os.path.join(output_folder(task), DONE_FILENAME))
+        except FileNotFoundError:
+            pass
+
+    os.makedirs(output_folder(task), exist_ok=True)
+    _watch_search(task, watcher)
+
+    # We want it after all, even if the last page watching it just left
+    try:
+        os.remove(os.path.join(_state_folder(task), CANCEL_FILENAME))
+    except FileNotFoundError:
+        pass
+
+    # Somebody else is already running this exact search, we simply poll the same task
+    time_limit = search_time_limit(search_parameters)
+    if not _claim_search(task, time_limit):
+        return task
+
+    try:
+        if is_batch(search_parameters):
+            tasks.task_domainmasst.apply_async(args=[task, search_parameters], task_id=task,
+                                               queue=BATCH_QUEUE, time_limit=time_limit)
+        else:
+            tasks.task_domainmasst.apply_async(args=[task, search_parameters], task_id=task)
+    except Exception:
+        _release_search(task)
+        raise
+
+    return task
+
+
+def search_status(task, watcher=None):
+    """
+    Lightweight status check for polling, looks at the output folder first and only then asks celery.
+
+    :param watcher: id of the polling page, keeps the search from being considered abandoned
+    :return: celery state, e.g. PENDING, STARTED, SUCCESS, FAILURE
+    """
+    _watch_search(task, watcher)
+
+    search_done = _read_search_done(task)
+    if search_done is not None:
+        return "SUCCESS" if search_done["exit_status"] == 0 else "FAILURE"
+
+    # Nothing finished within the time limit of the claim, its worker was killed and celery may never hear of it
+    if _expire_stale_claim(task):
+        # Kept as a failed run, so the next polls agree and a new submission retries it
+        with open(os.path.join(_state_folder(task), DONE_FILENAME), "w") as o:
+            json.dump({"task": task, "exit_status": masst_runner.EXIT_STATUS["timed_out"], "stale_claim": True}, o)
+
+        return "FAILURE"
+
+    import tasks
+
+    state = tasks.celery_instance.AsyncResult(task).state
+
+    # A retry of an earlier failed run is queued under the same task id
+    if state in FINISHED_STATES and os.path.isfile(os.path.join(_state_folder(task), INFLIGHT_FILENAME)):
+        return "PENDING"
+
+    return state
+
+
+def partial_matches(task, max_rows=PARTIAL_MATCHES_MAX_ROWS):
+    """
+    The fastMASST matches of a search that is still rendering its trees. microbe_masst writes
+    fastMASST_matches.tsv right after the fastMASST query, well before the html is done.
+
+    :return: list of match dicts (at most max_rows) or None if there are no matches yet
+    """
+    matches_filename = os.path.join(output_folder(task), "fastMASST_matches.tsv")
+
+    # Still being written
+    try:
+        if time.time() - os.path.getmtime(matches_filename) < 1:
+            return None
+    except OSError:
+        return None
+
+    import pandas as pd
+
+    try:
+        matches_df = pd.read_csv(matches_filename, sep="\t", nrows=max_rows)
+    except (OSError, ValueError):
+        return None
+
+    # NaN is not valid json for the page
+    matches_df = matches_df.astype(object).where(pd.notnull(matches_df), None)
+
+    return matches_df.to_dict(orient="records")
+
+
+def _batch_query_order(query):
+    # Numbered queries in numeric order, e.g. 2 before 10
+    return (0, int(query), "") if query.isdigit() else (1, 0, query)
+
+
+def batch_results(task):
+    """
+    One entry per query spectrum of a batch search, from the <out_file>_<query>_matches.tsv files that
+    masst_batch_client.py writes for every spectrum.
+
+    :return: list of dicts with query, matches (number of rows) and html_files (the domain results of this query)
+    """
+    output_temp = output_folder(task)
+    if not os.path.isdir(output_temp):
+        return []
+
+    filenames = sorted(os.listdir(output_temp))
+
+    results = []
+    for filename in filenames:
+        if not filename.startswith("fastMASST_") or not filename.endswith("_matches.tsv"):
+            continue
+
+        prefix = filename[:-len("_matches.tsv")]
+        with open(os.path.join(output_temp, filename)) as f:
+            matches = max(sum(1 for line in f) - 1, 0)
+
+        results.append({
+            "query": prefix[len("fastMASST_"):],
+            "matches": matches,
+            "html_files": [html_filename for html_filename in filenames
+                           if html_filename.startswith(prefix + "_") and html_filename.endswith(".html")],
+        })
+
+    return sorted(results, key=lambda result: _batch_query_order(result["query"]))
+
+
+def batch_matches(task):
+    """
+    :return: the matches of every query spectrum of a batch search as one table, with a query column
+    """
+    import pandas as pd
+
+    matches_list = []
+    for result in batch_results(task):
+        if result["matches"] == 0:
+            continue
+
+        matches_df = pd.read_csv(os.path.join(output_folder(task), "fastMASST_{}_matches.tsv".format(result["query"])), sep="\t")
+        matches_df.insert(0, "query", result["query"])
+        matches_list.append(matches_df)
+
+    if len(matches_list) == 0:
+        return pd.DataFrame(columns=["query"])
+
+    return pd.concat(matches_list, ignore_index=True)
+
+
+# The callbacks of the domain dashboards, every dashboard only wires its components to these
+
+
+def search_parameters_from_form(button_id, form, mgf_upload=None, database=None):
+    """
+    Search parameters of the search button that was clicked on a dashboard.
+
+    :param form: dict with the values of the dashboard inputs usi, peaks, precursor_mz, pm_tolerance,
+                 fragment_tolerance, cosine_threshold, min_matched_peaks, analog, delta_mass_below,
+                 delta_mass_above and optionally charge and max_peaks
+    :param mgf_upload: data of the mgf_upload_data store, see upload_view
+    :param database: fasst database, None for the microbe_masst default
+    :return: search parameters for submit_search, raises ValueError with a message for the page
+    """
+    usi = form["usi"]
+    # If USI is a list
+    if len(usi) == 1:
+        usi = usi[0]
+
+    search_parameters = {
+        "precursor_mz_tol": form["pm_tolerance"],
+        "mz_tol": form["fragment_tolerance"],
+        "min_cos": form["cosine_threshold"],
+        "min_matched_signals": form["min_matched_peaks"],
+        "analog": form["analog"] == "Yes",
+        "analog_mass_below": form["delta_mass_below"],
+        "analog_mass_above": form["delta_mass_above"],
+    }
+    if database is not None:
+        search_parameters["database"] = database
+
+    peaks = form["peaks"]
+    max_peaks = form.get("max_peaks")
+
+    if button_id == "search_button_usi":
+        search_parameters["usi"] = usi
+        if "max_peaks" in form:
+            # With max_peaks the worker retrieves the peaks and searches the top N as an MGF
+            search_parameters["max_peaks"] = max_peaks
+
+    elif button_id == "search_button_peaks" and looks_like_mgf(peaks):
+        # Several spectra pasted as an MGF, searched as one batch
+        try:
+            search_parameters["mgf"] = batch_mgf(parse_mgf(peaks))
+        except ValueError as e:
+            raise ValueError("Could not read the MGF: {}".format(e))
+
+    elif button_id == "search_button_file":
+        if mgf_upload is None:
+            raise ValueError("Select a file to search first")
+
+        if "error" in mgf_upload:
+            raise ValueError(mgf_upload["error"])
+
+        # Read once when it was selected, see upload_view
+        search_parameters["mgf"] = load_upload(mgf_upload["upload"])
+        if search_parameters["mgf"] is None:
+            raise ValueError("{} expired, select it again".format(mgf_upload["filename"]))
+
+    elif button_id == "search_button_peaks":
+        # The worker writes out the MGF file if we are using peaks, only the top N peaks with max_peaks
+        search_parameters["peaks"] = sort_and_filter_by_intensity(peaks.replace(",", " ").replace("\t", " "), max_peaks)
+        search_parameters["precursor_mz"] = form["precursor_mz"]
+        # default charge to 1 if not passed
+        search_parameters["charge"] = 1 if form.get("charge") is None else form["charge"]
+
+    return search_parameters
+
+
+def search_task_from_form(button_id, form, mgf_upload=None, previous_search_task=None, database=None):
+    """
+    Submits the search of a dashboard form and stops the previous search of the page.
+
+    :return: data for the search_task store, polled by status_view
+    """
+    try:
+        search_parameters = search_parameters_from_form(button_id, form, mgf_upload, database)
+    except ValueError as e:
+        return {"error": str(e)}
+
+    import uuid
+    watcher = str(uuid.uuid4())
+    task = submit_search(search_parameters, watcher=watcher)
+
+    # Stop the previous search of this page, unless another page is waiting for it too
+    if previous_search_task is not None and previous_search_task.get("task") not in [None, task]:
+        cancel_search(previous_search_task["task"], previous_search_task["watcher"])
+
+    return {"task": task, "analog": search_parameters["analog"], "watcher": watcher, "batch": is_batch(search_parameters)}
+
+
+def upload_view(contents, filename, button_label):
+    """
+    Reads a file selected on a dashboard, it is parsed once here and kept on the server.
+
+    :param button_label: label of the search button of the dashboard
+    :return: children of mgf_upload and the data of the mgf_upload_data store
+    """
+    import dash
+    from dash import html
+
+    if contents is None:
+        return [dash.no_update, dash.no_update]
+
+    try:
+        upload_id, spectrum_count = save_upload(filename, contents)
+    except Exception as e:
+        error = "Could not read {}: {}".format(filename, e)
+        return [html.Div(error), {"error": error}]
+
+    return [html.Div("Selected {} with {} spectra, click '{}' to search all of them".format(filename, spectrum_count, button_label)),
+            {"upload": upload_id, "filename": filename}]
+
+
+def status_view(search_task, partial_matches_shown, new_search, results_url):
+    """
+    What a dashboard shows for a search while it is polled.
+
+    :param new_search: the search_task store changed, so the matches of the previous search go
+    :param results_url: results page of the dashboard, formatted with task and analog
+    :return: children of the output, search_poll disabled, partial_matches children and partial_matches_shown
+    """
+    import dash
+    from dash import html, dash_table
+
+    # Nothing submitted yet
+    if search_task is None:
+        return [dash.no_update, True, dash.no_update, dash.no_update]
+
+    if "error" in search_task:
+        return [search_task["error"], True, None, False]
+
+    if new_search:
+        partial_matches_shown = False
+
+    status = search_status(search_task["task"], search_task["watcher"])
+
+    if status not in FINISHED_STATES:
+        # The matches are there before the trees, show them while we wait. Only once, so paging is not reset.
+        if not partial_matches_shown and not search_task.get("batch"):
+            matches = partial_matches(search_task["task"])
+            if matches is not None:
+                matches_view = [
+                    html.H5("fastMASST Matches ({}), the trees are still rendering...".format(len(matches))),
+                    dash_table.DataTable(
+                        id="matches_table",
+                        columns=[{"name": column, "id": column} for column in (matches[0].keys() if len(matches) > 0 else [])],
+                        data=matches,
+                        page_size=10,
+                        sort_action="native",
+                        filter_action="native",
+                        style_table={"overflowX": "auto"},
+                    ),
+                ]
+                return [status_message(status), False, matches_view, True]
+
+        return [status_message(status), False, None if new_search else dash.no_update,
+                False if new_search else dash.no_update]
+
+    if search_task.get("batch"):
+        response_list = [html.Iframe(src="/masst/batchresults?task={}".format(search_task["task"]), width="100%", height="900px")]
+        response_list.append(html.Br())
+        response_list.append(html.A("Download All Matches", href="/masst/batchresults?task={}&format=tsv".format(search_task["task"]), target="_blank"))
+        return [response_list, True, None, False]
+
+    url = results_url.format(task=search_task["task"], analog=search_task["analog"])
+    response_list = [html.Iframe(src=url, width="100%", height="900px")]
+
+    # Creating download link for the results
+    response_list.append(html.Br())
+    response_list.append(html.A("Download Results", href=url, download="mangling.html", target="_blank"))
+    return [response_list, True, None, False]
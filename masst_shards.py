@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Splits the ./bin/search library into precursor m/z shards, so one query is searched by several workers at once.
+
+The shards are built from the library MGF files, each shard holds the spectra of one precursor m/z range
+(about the same number of spectra per shard) and is indexed with ./bin/load into its own library folder:
+
+    python masst_shards.py library_list.txt --shards 8
+
+The spectra keep their file name and scan, so the Accession and DB Scan of the results stay the same.
+./bin/load adds to an existing library, so every build goes into a new bin/shards/build_<time> folder.
+bin/shards/shards.json lists the libraries of the current build with their m/z range,
+tasks.submit_searchmasst_sharded sends a query to every shard its precursor can match in and merges the best
+matches.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import masst_runner
+
+SHARDS_FOLDER = os.path.join("bin", "shards")
+MANIFEST_FILENAME = "shards.json"
+
+LOAD_BINARY = "./bin/load"
+
+# m/z around the query precursor that has to be searched, analog searches match across a wide window
+PM_TOLERANCE = float(os.environ.get("MASST_SHARD_PM_TOLERANCE", 2.0))
+ANALOG_MZ_WINDOW = float(os.environ.get("MASST_SHARD_ANALOG_MZ_WINDOW", 200.0))
+
+# Matches kept per query after merging the shards
+TOP_K = int(os.environ.get("MASST_SHARD_TOP_K", 1000))
+
+
+def _read_mgf_spectra(filename):
+    """
+    Streams the spectra of a library MGF file.
+
+    :return: generator of (lines, precursor m/z), the lines always contain a SCANS entry
+    """
+    lines = None
+    precursor_mz = None
+    has_scan = False
+    scan = 0
+
+    with open(filename) as f:
+        for line in f:
+            stripped = line.strip()
+            upper = stripped.upper()
+
+            if upper == "BEGIN IONS":
+                lines = [line]
+                precursor_mz = None
+                has_scan = False
+                scan += 1
+            elif lines is None:
+                continue
+            elif upper == "END IONS":
+                if not has_scan:
+                    # Scans without a SCANS entry are numbered by their position in the file
+                    lines.insert(1, "SCANS={}\n".format(scan))
+                lines.append(line if line.endswith("\n") else line + "\n")
+                if precursor_mz is not None:
+                    yield lines, precursor_mz
+                lines = None
+            else:
+                if upper.startswith("PEPMASS="):
+                    precursor_mz = float(stripped.split("=", 1)[1].split()[0])
+                elif upper.startswith("SCANS="):
+                    has_scan = True
+                lines.append(line)
+
+
+def shard_boundaries(precursor_mzs, shard_count):
+    """
+    :return: shard_count - 1 m/z values that split the spectra into shards of about the same size
+    """
+    precursor_mzs = sorted(precursor_mzs)
+    if len(precursor_mzs) == 0:
+        return []
+
+    return [precursor_mzs[len(precursor_mzs) * i // shard_count] for i in range(1, shard_count)]
+
+
+def _shard_index(boundaries, precursor_mz):
+    shard = 0
+    while shard < len(boundaries) and precursor_mz >= boundaries[shard]:
+        shard += 1
+
+    return shard
+
+
+def build_shards(library_files, shard_count, shards_folder=SHARDS_FOLDER, load_binary=LOAD_BINARY):
+    """
+    Writes the spectra of the library files into shard_count shards and indexes every shard with ./bin/load.
+
+    :param library_files: list of library MGF files
+    :return: manifest, list of dicts with name, library, min_mz, max_mz and spectra per shard
+    """
+    precursor_mzs = [precursor_mz for filename in library_files for lines, precursor_mz in _read_mgf_spectra(filename)]
+    boundaries = shard_boundaries(precursor_mzs, shard_count)
+
+    # A fresh folder, the searches keep using the previous build until the manifest points to this one
+    previous_manifest = load_manifest(shards_folder)
+    build_folder = os.path.join(shards_folder, "build_{}_{}".format(time.strftime("%Y%m%d%H%M%S"), os.getpid()))
+
+    shards = []
+    for i in range(shard_count):
+        shard_folder = os.path.join(build_folder, "shard_{}".format(i))
+        os.makedirs(os.path.join(shard_folder, "mgf"), exist_ok=True)
+        shards.append({
+            "name": "shard_{}".format(i),
+            "folder": shard_folder,
+            "library": os.path.join(shard_folder, "library"),
+            "min_mz": None,
+            "max_mz": None,
+            "spectra": 0,
+            "files": [],
+        })
+
+    for file_index, filename in enumerate(library_files):
+        shard_files = {}
+        try:
+            for lines, precursor_mz in _read_mgf_spectra(filename):
+                shard = shards[_shard_index(boundaries, precursor_mz)]
+
+                if shard["name"] not in shard_files:
+                    # The accession of the results comes from the file name, so it keeps its name. Each library
+                    # file gets its own folder, files with the same name from different folders stay apart
+                    shard_filename = os.path.join(shard["folder"], "mgf", str(file_index), os.path.basename(filename))
+                    os.makedirs(os.path.dirname(shard_filename), exist_ok=True)
+                    shard_files[shard["name"]] = open(shard_filename, "w")
+                    shard["files"].append(shard_filename)
+
+                shard_files[shard["name"]].writelines(lines)
+                shard["spectra"] += 1
+                shard["min_mz"] = precursor_mz if shard["min_mz"] is None else min(shard["min_mz"], precursor_mz)
+                shard["max_mz"] = precursor_mz if shard["max_mz"] is None else max(shard["max_mz"], precursor_mz)
+        finally:
+            for shard_file in shard_files.values():
+                shard_file.close()
+
+    manifest = []
+    for shard in shards:
+        if shard["spectra"] == 0:
+            continue
+
+        list_filename = os.path.join(shard["folder"], "library_list.txt")
+        with open(list_filename, "w") as f:
+            f.write("".join(os.path.abspath(shard_filename) + "\n" for shard_filename in shard["files"]))
+
+        print("Indexing", shard["name"], shard["spectra"], "spectra", shard["min_mz"], "-", shard["max_mz"], file=sys.stderr, flush=True)
+        run_result = masst_runner.run_command([load_binary, list_filename, "-r", "-l", shard["library"]], timeout=24 * 3600)
+        if run_result["exit_status"] != 0:
+            raise Exception("Indexing {} failed {}".format(shard["name"], run_result))
+
+        manifest.append({key: shard[key] for key in ["name", "library", "min_mz", "max_mz", "spectra"]})
+
+    manifest_filename = os.path.join(shards_folder, MANIFEST_FILENAME)
+    with open(manifest_filename + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+    _remove_old_builds(shards_folder, build_folder, previous_manifest)
+
+    return manifest
+
+
+def _remove_old_builds(shards_folder, build_folder, previous_manifest):
+    """
+    Removes the shards of older builds, the previous one stays for the searches that are still running on it.
+    """
+    keep = {os.path.realpath(build_folder)}
+    for shard in previous_manifest or []:
+        # library is <build>/shard_<i>/library, or shard_<i>/library before the build folders
+        shard_folder = os.path.dirname(shard["library"])
+        keep.update({os.path.realpath(shard_folder), os.path.realpath(os.path.dirname(shard_folder))})
+
+    for name in os.listdir(shards_folder):
+        folder = os.path.join(shards_folder, name)
+        # Also the shard_<i> folders of the builds from before the build folders
+        if os.path.isdir(folder) and (name.startswith("build_") or name.startswith("shard_")) \
+                and os.path.realpath(folder) not in keep:
+            print("Removing old shards", folder, file=sys.stderr, flush=True)
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def load_manifest(shards_folder=SHARDS_FOLDER):
+    """
+    :return: list of shards, None when the library is not sharded
+    """
+    try:
+        with open(os.path.join(shards_folder, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def search_window(precursor_mz, analog_search):
+    window = ANALOG_MZ_WINDOW if analog_search == "Yes" else PM_TOLERANCE
+
+    return precursor_mz - window, precursor_mz + window
+
+
+def shards_for_query(manifest, precursor_mz, analog_search):
+    """
+    :return: the shards with spectra that the precursor m/z can match
+    """
+    low_mz, high_mz = search_window(precursor_mz, analog_search)
+
+    return [shard for shard in manifest if shard["max_mz"] >= low_mz and shard["min_mz"] <= high_mz]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Splits the library into precursor m/z shards for the sharded search")
+    parser.add_argument("library", help="library MGF file, or a file listing them with --reference-list")
+    parser.add_argument("--reference-list", "-r", action="store_true", help="library is a list of MGF files")
+    parser.add_argument("--shards", type=int, default=os.cpu_count(), help="number of shards")
+    parser.add_argument("--output", default=SHARDS_FOLDER, help="shards folder")
+    parser.add_argument("--load", default=LOAD_BINARY, help="./bin/load binary")
+    args = parser.parse_args()
+
+    if args.reference_list:
+        with open(args.library) as f:
+            library_files = [line.strip() for line in f if len(line.strip()) > 0]
+    else:
+        library_files = [args.library]
+
+    for shard in build_shards(library_files, args.shards, shards_folder=args.output, load_binary=args.load):
+        print(shard["name"], shard["spectra"], "spectra", shard["min_mz"], "-", shard["max_mz"])
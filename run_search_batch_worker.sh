@@ -0,0 +1,5 @@
+#!/bin/bash
+
+source activate python3
+# Few concurrent batches, every batch already searches MASST_BATCH_PARALLEL_QUERIES spectra in parallel
+celery -A tasks worker -l info -c 2 -Q searchbatchworker -n searchbatchworker@%h --max-tasks-per-child 20 --loglevel INFO
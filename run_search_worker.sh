@@ -0,0 +1,6 @@
+#!/bin/bash
+
+source activate python3
+# -B runs the beat schedule (hourly temp cleanup) in this worker, there is only one search worker
+# One child per masst_runner slot, more children would only hold warm memory while waiting for a slot
+celery -A tasks worker -B -s temp/celerybeat-schedule -l info -c ${MASST_MAX_CONCURRENT_RUNS:-4} -Q searchworker -n searchworker@%h --max-tasks-per-child 200 --loglevel INFO
@@ -1,91 +1,352 @@
-from celery import Celery
-from celery.signals import worker_ready
+from celery import Celery, chord, group
+from celery.signals import worker_ready, worker_init
 
+import concurrent.futures
 import glob
 import sys
 import os
-import uuid
-import requests
-import requests_cache
 import pandas as pd
 
-# Requests cache for massive information, that expires after 24 hours
-requests_cache.install_cache('temp/requests_cache', expire_after=84600)
+import masst_datasets
+import masst_http
+import masst_index
+import masst_janitor
+import masst_results
+import masst_runner
+import masst_search
+import masst_shards
 
 @worker_ready.connect
-def onstart(**k):
-    all_gnps_datasets = requests.get("https://massive.ucsd.edu/ProteoSAFe/QueryDatasets?pageSize=3000&offset=0&query={%22title_input%22:%22GNPS%22}").json()
-    _dataset_df = pd.DataFrame(all_gnps_datasets["row_data"])
-    _dataset_df.to_feather("datasets.feather")
+def onstart(sender=None, **k):
+    # Only the ./bin/search results need the dataset titles, task_refreshdatasets keeps the snapshot up to date
+    if "worker" in sender.app.amqp.queues and not masst_datasets.has_snapshot():
+        masst_datasets.sync()
+
+@worker_init.connect
+def onworkerinit(sender=None, **k):
+    # Requests cache for the outbound calls of the ./bin/search worker (the MassIVE datasets are synced by
+    # masst_datasets), expires after 24 hours. It patches requests for the whole process, so not at import (the
+    # web process imports this module to submit searches) and not on the search workers, microbe_masst runs in
+    # process there and its fasst queries have to see the new index after the nightly refresh.
+    if "worker" in sender.app.amqp.queues:
+        masst_http.install_cache('temp/requests_cache', expire_after=84600)
+
+    # Only the search workers run microbe_masst, load it before the pool forks so every child starts warm
+    if "searchworker" in sender.app.amqp.queues or masst_search.BATCH_QUEUE in sender.app.amqp.queues:
+        masst_search.warm_up()
+
+    # ./bin/search runs on the worker queue, the search index and the dataset titles of its results are loaded
+    # once for the children
+    if "worker" in sender.app.amqp.queues:
+        if SEARCH_ENGINE == "index":
+            masst_index.resident_index()
+        masst_datasets.load()
 
 celery_instance = Celery('tasks', backend='redis://masst-redis', broker='pyamqp://guest@masst-rabbitmq//', )
 
 @celery_instance.task(time_limit=60)
 def task_computeheartbeat():
-    print("UP", file=sys.stderr, flush=True)
+    print("UP", masst_datasets.dataset_count(), "datasets", file=sys.stderr, flush=True)
     return "Up"
 
+# The whole library is searched with the index the worker keeps loaded (see masst_index) when one is built,
+# MASST_SEARCH_ENGINE=bin always starts ./bin/search. The shards are always searched with ./bin/search
+SEARCH_ENGINE = os.environ.get("MASST_SEARCH_ENGINE", "index")
+
+# ./bin/search reads the query and writes the results through named pipes, MASST_SEARCH_IO=files uses temporary files
+SEARCH_USE_PIPES = os.environ.get("MASST_SEARCH_IO", "pipes") != "files"
+
+# USIs fetched at the same time by a batch search
+USI_RESOLVE_THREADS = 8
+
+# Spectra per ./bin/search run, larger batches are split over the workers as a celery group
+SEARCH_BATCH_CHUNK_SIZE = int(os.environ.get("MASST_SEARCH_BATCH_CHUNK_SIZE", 50))
+
+def _tsv_value(value):
+    for cast in [int, float]:
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+
+    return value
+
+def _resolve_query(query):
+    """
+    :param query: USI, or dict with precursor_mz and peaks as [[m/z, intensity], ...]
+    :return: dict with precursor_mz and peaks
+    """
+    if isinstance(query, str):
+        spectrum_json = masst_http.get("https://metabolomics-usi.gnps2.org/json/?usi1={}".format(query)).json()
+        return {"precursor_mz": spectrum_json["precursor_mz"], "peaks": spectrum_json["peaks"]}
+
+    return query
+
+def _resolve_queries(queries):
+    """
+    Fetches the spectra of the USIs at the same time, over the pooled connections.
+
+    :return: list of spectra in the order of queries, None for the ones that could not be resolved
+    """
+    def resolve(query):
+        try:
+            return _resolve_query(query)
+        except Exception as e:
+            print("Could not resolve", query, repr(e), file=sys.stderr, flush=True)
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=USI_RESOLVE_THREADS) as executor:
+        return list(executor.map(resolve, queries))
+
+RESULT_COLUMNS = ["Accession", "title", "DB Scan", "Score", "Matched Peaks", "M/Z Delta"]
+
+def _format_results(results_df):
+    # Adding dataset information, from the titles kept by the worker, see masst_datasets
+    results_df = results_df.assign(Accession=masst_datasets.accessions(results_df["DB File"]))
+    results_df["title"] = masst_datasets.titles(results_df["Accession"])
+
+    results_df = results_df[RESULT_COLUMNS]
+
+    # Column by column for the result backend, masst_results.to_records turns it back into records
+    return masst_results.encode(results_df)
+
+def _search_rows_resident(spectra, analog_search, timeout):
+    """
+    :return: header and rows of the results from the index kept by the worker, None without an index
+    """
+    index = masst_index.resident_index()
+    if index is None:
+        return None
+
+    print("Resident index", len(spectra), "spectra", file=sys.stderr, flush=True)
+
+    rows = []
+
+    def search_resident_index():
+        rows.extend(masst_index.search_rows(index, spectra, analog_search))
+
+    # Same time, memory and concurrency limits as a ./bin/search run
+    run_result = masst_runner.run_in_process(search_resident_index, (), timeout=timeout)
+    if run_result["exit_status"] != 0:
+        raise Exception("Search failed {}".format(run_result))
+
+    return masst_index.RESULT_COLUMNS, rows
+
+def _search_rows_bin(spectra, analog_search, timeout, library):
+    """
+    :return: header and rows of the results of a single ./bin/search run
+    """
+    # The scan number maps the results back to the spectrum
+    query_mgf = ""
+    for scan, spectrum in enumerate(spectra, start=1):
+        if spectrum is None:
+            continue
+
+        query_mgf += "BEGIN IONS\nSEQ=*..*\nSCANS={}\nPEPMASS={}\n".format(scan, spectrum["precursor_mz"])
+        query_mgf += "".join("{} {}\n".format(peak[0], peak[1]) for peak in spectrum["peaks"])
+        query_mgf += "END IONS\n"
+
+    search_arguments = ["./bin/search", "{input}", "-l", library, "-o", "{output}"]
+    if analog_search == "Yes":
+        search_arguments.insert(2, "-a")
+
+    print(" ".join(search_arguments), len(spectra), "spectra", file=sys.stderr, flush=True)
+
+    # The results are parsed as ./bin/search writes them, nothing goes through temp
+    header = []
+    rows = []
+
+    def parse_results_line(line):
+        values = line.rstrip("\n").split("\t")
+        if len(header) == 0:
+            header.extend(values)
+        elif len(values) == len(header):
+            rows.append([_tsv_value(value) for value in values])
+
+    run_result = masst_runner.run_command_with_pipes(search_arguments, query_mgf,
+                                                     input_filename="query.mgf", output_filename="results.tsv",
+                                                     on_output_line=parse_results_line, use_pipes=SEARCH_USE_PIPES,
+                                                     timeout=timeout)
+    if run_result["exit_status"] != 0:
+        raise Exception("Search failed {}".format(run_result))
+
+    return header, rows
+
+def _search_spectra(spectra, analog_search, timeout, library="./bin/library"):
+    """
+    Searches all spectra at once, with the index the worker keeps loaded or with a single ./bin/search run,
+    so the library is read once for the whole batch.
+
+    :param spectra: list of dicts with precursor_mz and peaks, None entries are skipped
+    :param library: library folder, e.g. a shard from masst_shards
+    :return: list of results per spectrum (see masst_results), None for the skipped ones
+    """
+    if all(spectrum is None for spectrum in spectra):
+        return [None] * len(spectra)
+
+    search_results = None
+    if SEARCH_ENGINE == "index" and library == "./bin/library":
+        search_results = _search_rows_resident(spectra, analog_search, timeout)
+    if search_results is None:
+        search_results = _search_rows_bin(spectra, analog_search, timeout, library)
+
+    header, rows = search_results
+    results_df = pd.DataFrame(rows, columns=header)
+
+    results_list = []
+    for scan, spectrum in enumerate(spectra, start=1):
+        if spectrum is None:
+            results_list.append(None)
+            continue
+
+        spectrum_results_df = results_df[results_df["Query Scan"] == scan].drop(["Query File", "Query Scan"], axis=1)
+        results_list.append(_format_results(spectrum_results_df))
+
+    return results_list
+
 @celery_instance.task(time_limit=60)
 def task_searchmasst(usi, analog_search):
     print(usi, file=sys.stderr, flush=True)
 
-    spectrum_json = requests.get("https://metabolomics-usi.gnps2.org/json/?usi1={}".format(usi)).json()
+    return _search_spectra([_resolve_query(usi)], analog_search, timeout=50)[0]
 
-    random_string = str(uuid.uuid4()).replace("-", "")
-    temp_query_mgf = os.path.join("temp", "{}.mgf".format(random_string))
-    temp_results_tsv = os.path.join("temp", "{}.tsv".format(random_string))
-    temp_cmd = os.path.join("temp", "{}.cmd".format(random_string))
+@celery_instance.task(time_limit=600)
+def task_searchmasst_batch(queries, analog_search):
+    """
+    Searches many spectra at once, see submit_searchmasst_batch for batches larger than a chunk.
 
-    with open(temp_query_mgf, "w") as o:
-        o.write("BEGIN IONS\n")
-        o.write("SEQ=*..*\n")
-        o.write("PEPMASS={}\n".format(spectrum_json["precursor_mz"]))
-        for peak in spectrum_json["peaks"]:
-            o.write("{} {}\n".format(peak[0], peak[1]))
-        o.write("END IONS\n")
+    :param queries: list of USIs or dicts with precursor_mz and peaks
+    :return: list of results per query (see masst_results), None for queries whose spectrum could not be resolved
+    """
+    print("Batch of", len(queries), file=sys.stderr, flush=True)
 
-    if analog_search == "Yes":
-        cmd = "./bin/search {} -a -l ./bin/library -o {} > /dev/null".format(temp_query_mgf, temp_results_tsv)
-    else:
-        cmd = "./bin/search {} -l ./bin/library -o {}  > /dev/null".format(temp_query_mgf, temp_results_tsv)
+    return _search_spectra(_resolve_queries(queries), analog_search, timeout=540)
+
+def submit_searchmasst_batch(queries, analog_search, chunk_size=SEARCH_BATCH_CHUNK_SIZE):
+    """
+    Splits a batch into chunks that are searched at the same time by the workers.
+
+    :return: celery GroupResult, join_searchmasst_batch turns it back into one list in the order of queries
+    """
+    chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+
+    return group(task_searchmasst_batch.s(chunk, analog_search) for chunk in chunks).apply_async()
+
+def join_searchmasst_batch(group_result, timeout=None):
+    return [results for chunk_results in group_result.get(timeout=timeout) for results in chunk_results]
 
-    with open(temp_cmd, "w") as o:
-        o.write(cmd)
-    
-    os.system(cmd)
+@celery_instance.task(time_limit=600)
+def task_searchshard(spectra, analog_search, library):
+    """
+    Searches one shard of the library, see submit_searchmasst_sharded.
 
-    results_df = pd.read_csv(temp_results_tsv, sep="\t")
-    results_df = results_df.drop(["Query File", "Query Scan"], axis=1)
+    :param spectra: list of spectra, None for the ones that can not match in this shard
+    """
+    return _search_spectra(spectra, analog_search, timeout=540, library=library)
 
-    # Adding dataset information
-    results_df["Accession"] = results_df["DB File"].apply(lambda x: os.path.basename(x).split("_")[0])
+@celery_instance.task(time_limit=120)
+def task_mergeshards(shard_results, top_k, resolved):
+    """
+    :param shard_results: list of the task_searchshard results
+    :param resolved: per spectrum whether it could be resolved
+    :return: list of results per spectrum, the top_k best scores over all shards
+    """
+    merged_results = []
+    for i, spectrum_resolved in enumerate(resolved):
+        if not spectrum_resolved:
+            merged_results.append(None)
+            continue
 
-    # Global data for datasets
-    # all_gnps_datasets = requests.get("https://massive.ucsd.edu/ProteoSAFe/QueryDatasets?pageSize=3000&offset=0&query={%22title_input%22:%22GNPS%22}").json()
-    # datasets_df = pd.DataFrame(all_gnps_datasets["row_data"])
+        shard_dfs = [masst_results.decode(results[i]) for results in shard_results if results[i] is not None]
+        if len(shard_dfs) == 0:
+            merged_results.append(masst_results.encode(pd.DataFrame(columns=RESULT_COLUMNS)))
+            continue
 
-    _dataset_df = pd.read_feather("datasets.feather")
-    merged_df = results_df.merge(_dataset_df, how="left", left_on="Accession", right_on="dataset")
-    results_df = merged_df[["Accession", "title", "DB Scan", "Score", "Matched Peaks", "M/Z Delta"]]
+        results_df = pd.concat(shard_dfs, ignore_index=True)
+        results_df = results_df.sort_values("Score", ascending=False, kind="stable").head(top_k)
+        merged_results.append(masst_results.encode(results_df))
 
-    try:
-        results_df["title"] = results_df["title"].astype(str)
-        results_df["title"] = results_df["title"].apply(lambda x: x[:40])
-    except:
-        pass
+    return merged_results
 
-    return results_df.to_dict(orient="records")
+def submit_searchmasst_sharded(queries, analog_search, top_k=masst_shards.TOP_K):
+    """
+    Searches the shards that each query can match in at the same time (a celery chord) and merges their matches.
+    Without a sharded library (see masst_shards) the whole ./bin/library is searched by a single task.
 
+    :param queries: list of USIs or dicts with precursor_mz and peaks
+    :return: celery AsyncResult, its result is a list of results per query like task_searchmasst_batch
+    """
+    spectra = _resolve_queries(queries)
 
-# celery_instance.conf.beat_schedule = {
-#     "cleanup": {
-#         "task": "tasks._task_cleanup",
-#         "schedule": 3600
-#     }
-# }
+    manifest = masst_shards.load_manifest()
+    if manifest is None:
+        manifest = [{"name": "library", "library": "./bin/library", "min_mz": 0, "max_mz": float("inf")}]
+
+    spectrum_shards = [
+        set() if spectrum is None else
+        {shard["name"] for shard in masst_shards.shards_for_query(manifest, spectrum["precursor_mz"], analog_search)}
+        for spectrum in spectra
+    ]
+
+    shard_searches = []
+    for shard in manifest:
+        shard_spectra = [spectrum if shard["name"] in shards else None for spectrum, shards in zip(spectra, spectrum_shards)]
+        if any(spectrum is not None for spectrum in shard_spectra):
+            shard_searches.append(task_searchshard.s(shard_spectra, analog_search, shard["library"]))
+
+    # A chord needs at least one task, this one has nothing to search
+    if len(shard_searches) == 0:
+        shard_searches.append(task_searchshard.s([None] * len(spectra), analog_search, manifest[0]["library"]))
+
+    resolved = [spectrum is not None for spectrum in spectra]
+
+    return chord(shard_searches)(task_mergeshards.s(top_k, resolved))
+
+# Domain MASST searches, submitted by the dashboards so the web threads do not wait on fastMASST.
+# Multi-spectrum batches are sent to masst_search.BATCH_QUEUE with a longer time limit instead.
+@celery_instance.task(time_limit=masst_search.SEARCH_TIME_LIMIT)
+def task_domainmasst(task, search_parameters):
+    return masst_search.run_search(task, search_parameters)
+
+
+# Keeps temp/microbemasst within its age and size quotas
+@celery_instance.task(time_limit=1800)
+def task_cleanup():
+    return masst_janitor.cleanup()
+
+
+# Fetches the new MassIVE datasets into the snapshot in temp, the workers reload the titles when it changes.
+# Runs on the search worker next to the beat, it is always deployed while the worker queue might not be
+@celery_instance.task(time_limit=900)
+def task_refreshdatasets(full=False):
+    return masst_datasets.sync(full=full)
+
+
+celery_instance.conf.beat_schedule = {
+    "cleanup": {
+        "task": "tasks.task_cleanup",
+        "schedule": 3600
+    },
+    "refresh_datasets": {
+        "task": "tasks.task_refreshdatasets",
+        "schedule": 3600
+    }
+}
 
 
 celery_instance.conf.task_routes = {
     'tasks.task_computeheartbeat': {'queue': 'worker'},
     'tasks.task_searchmasst': {'queue': 'worker'},
-}
\ No newline at end of file
+    'tasks.task_searchmasst_batch': {'queue': 'worker'},
+    'tasks.task_searchshard': {'queue': 'worker'},
+    'tasks.task_mergeshards': {'queue': 'worker'},
+    'tasks.task_domainmasst': {'queue': 'searchworker'},
+    'tasks.task_cleanup': {'queue': 'searchworker'},
+    'tasks.task_refreshdatasets': {'queue': 'searchworker'},
+}
+
+# So the dashboards can tell a queued search from a running one
+celery_instance.conf.task_track_started = True
+
+# Results are fetched right after the search, they do not need to stay in redis for the default day
+celery_instance.conf.result_expires = int(os.environ.get("MASST_RESULT_EXPIRES", 3600))
\ No newline at end of file
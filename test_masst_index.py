@@ -0,0 +1,59 @@
+import numpy as np
+
+import masst_catalog
+import masst_index
+import masst_scoring
+
+
+def write_mgf(filename, spectra):
+    with open(filename, "w") as f:
+        for scan, (precursor_mz, peaks) in enumerate(spectra, start=1):
+            f.write("BEGIN IONS\nPEPMASS={}\nSCANS={}\n".format(precursor_mz, scan))
+            f.write("".join("{} {}\n".format(mz, intensity) for mz, intensity in peaks))
+            f.write("END IONS\n")
+
+
+def random_spectra(rng, templates, count):
+    # Variants of a few templates, so the queries have real matches, exact and shifted
+    spectra = []
+    for i in range(count):
+        precursor_mz, peaks = templates[rng.integers(len(templates))]
+        shift = rng.choice([0.0, 0.0, 14.016])
+        keep = rng.random(len(peaks)) < 0.8
+        shifted = rng.random(len(peaks)) < 0.5
+        mz = peaks[:, 0] + np.where(shifted, shift, 0) + rng.normal(0, 0.003, len(peaks))
+        intensity = peaks[:, 1] * rng.uniform(0.5, 1.5, len(peaks))
+        spectra.append((precursor_mz + shift, np.round(np.column_stack([mz, intensity])[keep], 4)))
+
+    return spectra
+
+
+def test_search_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    templates = [(rng.uniform(300, 600), np.column_stack([np.sort(rng.uniform(50, 290, 15)), rng.uniform(1, 100, 15)]))
+                 for template in range(6)]
+
+    library_filename = str(tmp_path / "library.mgf")
+    write_mgf(library_filename, random_spectra(rng, templates, 200))
+    masst_index.build_index([library_filename], str(tmp_path / "index"), max_peaks=100)
+    index = masst_index.load_index(str(tmp_path / "index"))
+
+    library = list(masst_catalog.read_mgf_spectra(library_filename))
+
+    for precursor_mz, query_peaks in random_spectra(rng, templates, 20):
+        for analog_search in ["No", "Yes"]:
+            hits = masst_index.search(index, query_peaks, precursor_mz, analog_search, min_cosine=0.5, min_matched_peaks=3)
+
+            low_mz, high_mz = masst_catalog.search_window(precursor_mz, analog_search)
+            window = [spectrum for spectrum in library if low_mz <= spectrum[0] <= high_mz]
+            expected = {}
+            if len(window) > 0:
+                scores = masst_scoring.score_spectra({"precursor_mz": precursor_mz, "peaks": query_peaks},
+                                                     [{"precursor_mz": spectrum[0], "peaks": spectrum[2]} for spectrum in window],
+                                                     shifted=analog_search == "Yes")
+                expected = {spectrum[1]: score for spectrum, score, matched_peaks
+                            in zip(window, scores["score"], scores["matched_peaks"]) if score >= 0.5 and matched_peaks >= 3}
+
+            assert {hit["scan"] for hit in hits} == set(expected)
+            for hit in hits:
+                assert np.isclose(hit["score"], expected[hit["scan"]])
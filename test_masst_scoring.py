@@ -0,0 +1,73 @@
+import numpy as np
+
+import masst_scoring
+
+
+def sequential_greedy(products, query_keys, library_keys):
+    # Reference: one pair at a time by descending product, ties in the order of the pairs
+    taken = np.zeros(len(products), dtype=bool)
+    used_query = set()
+    used_library = set()
+
+    for pair in sorted(range(len(products)), key=lambda pair: (-products[pair], pair)):
+        if query_keys[pair] in used_query or library_keys[pair] in used_library:
+            continue
+
+        taken[pair] = True
+        used_query.add(query_keys[pair])
+        used_library.add(library_keys[pair])
+
+    return taken
+
+
+def sequential_score(query_peaks, query_precursor_mz, library_peaks, library_precursor_mz, shifted, tolerance=0.02):
+    query_peaks = np.asarray(query_peaks, dtype=np.float64)
+    library_peaks = np.asarray(library_peaks, dtype=np.float64)
+    query_intensity = np.sqrt(query_peaks[:, 1]) / np.linalg.norm(np.sqrt(query_peaks[:, 1]))
+    library_intensity = np.sqrt(library_peaks[:, 1]) / np.linalg.norm(np.sqrt(library_peaks[:, 1]))
+
+    shifts = [0.0, query_precursor_mz - library_precursor_mz] if shifted else [0.0]
+    pairs = sorted({(q, l) for q in range(len(query_peaks)) for l in range(len(library_peaks))
+                    if any(abs(query_peaks[q, 0] - library_peaks[l, 0] - shift) <= tolerance for shift in shifts)},
+                   key=lambda pair: (pair[1], pair[0]))
+
+    products = np.array([query_intensity[q] * library_intensity[l] for q, l in pairs])
+    taken = sequential_greedy(products, [q for q, l in pairs], [l for q, l in pairs])
+
+    return products[taken].sum() if len(pairs) > 0 else 0.0
+
+
+def test_greedy_assignment_matches_sequential():
+    rng = np.random.default_rng(0)
+
+    for case in range(300):
+        pair_count = rng.integers(0, 60)
+        # Few distinct products and peaks, so there are ties and conflicts
+        products = rng.integers(1, 6, pair_count).astype(np.float64)
+        query_keys = rng.integers(0, 8, pair_count)
+        library_keys = rng.integers(0, 8, pair_count)
+
+        np.testing.assert_array_equal(masst_scoring._greedy_assignment(products, query_keys, library_keys),
+                                      sequential_greedy(products, query_keys, library_keys))
+
+
+def test_score_matches_sequential():
+    rng = np.random.default_rng(1)
+
+    for case in range(50):
+        # Peaks on a coarse grid, so several fall within the tolerance of each other, none right at its edge
+        query_peaks = np.column_stack([rng.integers(0, 40, 12) * 0.01 + 100, rng.uniform(1, 100, 12)])
+        candidates = [{"precursor_mz": float(rng.uniform(300, 302)),
+                       "peaks": np.column_stack([rng.integers(0, 40, 10) * 0.01 + 100 + rng.choice([0, 1]),
+                                                 rng.uniform(1, 100, 10)])}
+                      for candidate in range(5)]
+        query = {"precursor_mz": 301.0, "peaks": query_peaks}
+
+        for shifted in [False, True]:
+            scores = masst_scoring.score_spectra(query, candidates, shifted=shifted, tolerance=0.015)["score"]
+            expected = [sequential_score(query_peaks[np.argsort(query_peaks[:, 0], kind="stable")], 301.0,
+                                         candidate["peaks"][np.argsort(candidate["peaks"][:, 0], kind="stable")],
+                                         candidate["precursor_mz"], shifted, tolerance=0.015)
+                        for candidate in candidates]
+
+            np.testing.assert_allclose(scores, expected)
@@ -1,20 +1,75 @@
 # views.py
-from flask import abort, render_template, request, redirect, make_response
+from flask import abort, render_template, request, redirect, make_response, jsonify, send_file
 import uuid
 import json
 import zipfile
 import io
 
 from app import app
-import requests
 import os
 
+import masst_http
+import masst_janitor
+import masst_search
+
 ALLOWED_EXTENSIONS = set(['mgf', 'mzxml', 'mzml'])
 
 @app.route('/heartbeat', methods=['GET'])
 def heartbeat():
     return '{"status" : "up"}'
 
+# Polled by the domain MASST dashboards while their search runs on the worker
+@app.route('/masst/status', methods=['GET'])
+def masst_status():
+    task = request.values.get("task")
+
+    if task is None:
+        abort(400, "Task not entered")
+
+    return jsonify({"task": task, "status": masst_search.search_status(task, request.values.get("watcher"))})
+
+@app.route('/masst/cachestats', methods=['GET'])
+def masst_cachestats():
+    return jsonify(masst_search.cache_stats())
+
+@app.route('/masst/httpstats', methods=['GET'])
+def masst_httpstats():
+    return jsonify(masst_http.http_stats())
+
+@app.route('/masst/janitorstats', methods=['GET'])
+def masst_janitorstats():
+    return jsonify(masst_janitor.janitor_stats())
+
+# Combined view of a multi-spectrum search, one row per query spectrum
+@app.route('/masst/batchresults', methods=['GET'])
+def masst_batchresults():
+    task = request.values.get("task")
+
+    if task is None:
+        abort(400, "Task not entered")
+
+    if request.values.get("format") == "tsv":
+        response = make_response(masst_search.batch_matches(task).to_csv(sep="\t", index=False))
+        response.headers["Content-Type"] = "text/tab-separated-values"
+        response.headers["Content-Disposition"] = "attachment; filename=masst_batch_matches.tsv"
+        return response
+
+    return render_template('batchresults.html', task=task, results=masst_search.batch_results(task))
+
+@app.route('/masst/batchresults/html', methods=['GET'])
+def masst_batchresults_html():
+    task = request.values.get("task")
+    filename = os.path.basename(request.values.get("filename", ""))
+
+    if task is None or not filename.endswith(".html"):
+        abort(400, "Task or filename not entered")
+
+    html_file = os.path.join(masst_search.output_folder(task), filename)
+    if not os.path.isfile(html_file):
+        abort(404)
+
+    return send_file(html_file)
+
 @app.route('/', methods=['GET'])
 def homepage():
     response = make_response(render_template('dashboard.html'))
@@ -128,7 +183,7 @@ def invoke_workflow(base_url, parameters, login, password):
     username = login
     password = password
 
-    s = requests.Session()
+    s = masst_http.new_session()
 
     payload = {
         'user' : username,
@@ -136,8 +191,8 @@ def invoke_workflow(base_url, parameters, login, password):
         'login' : 'Sign in'
     }
 
-    r = s.post('https://' + base_url + '/ProteoSAFe/user/login.jsp', data=payload, verify=False)
-    r = s.post('https://' + base_url + '/ProteoSAFe/InvokeTools', data=parameters, verify=False)
+    r = masst_http.post('https://' + base_url + '/ProteoSAFe/user/login.jsp', session=s, data=payload, verify=False)
+    r = masst_http.post('https://' + base_url + '/ProteoSAFe/InvokeTools', session=s, data=parameters, verify=False)
     task_id = r.text
 
     import sys
@@ -158,7 +213,7 @@ def foodmasstresult():
 
     # Checking if the task is the proper type
     url = "https://gnps.ucsd.edu/ProteoSAFe/status_json.jsp?task={}".format(task)
-    r = requests.get(url)
+    r = masst_http.get(url)
 
     if r.status_code != 200:
         return "Error: Task not found"
@@ -170,7 +225,7 @@ def foodmasstresult():
 
     # Getting the actual html and displaying it
     download_url = "https://proteomics2.ucsd.edu/ProteoSAFe/DownloadResult?task={}&view=download_food_tree_html".format(task)
-    response = requests.post(download_url)
+    response = masst_http.post(download_url)
     with zipfile.ZipFile(io.BytesIO(response.content)) as thezip:
         for zipinfo in thezip.infolist():
             with thezip.open(zipinfo) as thefile:
@@ -186,7 +241,7 @@ def personalcaremasstresult():
 
     # Checking if the task is the proper type
     url = "https://gnps.ucsd.edu/ProteoSAFe/status_json.jsp?task={}".format(task)
-    r = requests.get(url)
+    r = masst_http.get(url)
 
     if r.status_code != 200:
         return "Error: Task not found"
@@ -198,7 +253,7 @@ def personalcaremasstresult():
 
     # Getting the actual html and displaying it
     download_url = "https://proteomics2.ucsd.edu/ProteoSAFe/DownloadResult?task={}&view=download_personalcare_tree_html".format(task)
-    response = requests.post(download_url)
+    response = masst_http.post(download_url)
     with zipfile.ZipFile(io.BytesIO(response.content)) as thezip:
         for zipinfo in thezip.infolist():
             with thezip.open(zipinfo) as thefile: